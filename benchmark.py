@@ -0,0 +1,358 @@
+import sys
+import random
+import socket
+import itertools
+import timeit
+import json
+from model import Card
+import setfinder
+import protocol
+import remote
+import metrics
+from transport import Connection
+from host import Game, is_set
+from simulator import NullSession
+from timers import TimerWheel
+from spectators import SpectatorFeed
+from logger import *
+
+BOARD_SIZES = (12, 15, 18)
+
+def combinations_has_set(board):
+    # The itertools.combinations scan Game.has_set used originally
+    for c1, c2, c3 in itertools.combinations(board, 3):
+        if c1.third(c2) == c3:
+            return True
+    return False
+
+def combinations_count_sets(board):
+    return sum(1 for c1, c2, c3 in itertools.combinations(board, 3)
+               if c1.third(c2) == c3)
+
+def random_boards(size, n, seed=0):
+    rng = random.Random(seed)
+    return [rng.sample(Card.ALL, size) for _ in range(n)]
+
+def time_per_call(fn, args_list, repeat=3):
+    def run():
+        for args in args_list:
+            fn(args)
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    return best / len(args_list)
+
+def time_with_setup(setup, fn, n, repeat=3):
+    # For calls that change their argument: every repeat gets fresh ones,
+    # built outside the timed loop
+    best = None
+    for _ in range(repeat):
+        args_list = [setup(i) for i in range(n)]
+        secs = min(timeit.repeat(lambda: [fn(args) for args in args_list],
+                                 number=1, repeat=1))
+        best = secs if best is None else min(best, secs)
+    return best / n
+
+def bench_model(n=20000):
+    rng = random.Random(0)
+    pairs = [tuple(rng.sample(Card.ALL, 2)) for _ in range(n)]
+    triples = [(a, b, rng.choice([a.third(b), rng.choice(Card.ALL)])) for a, b in pairs]
+    return dict(model=dict(
+        card_third = time_per_call(lambda p: p[0].third(p[1]), pairs),
+        is_set = time_per_call(lambda t: is_set(*t), triples),
+    ))
+
+def new_game(seed, n_cards=None):
+    random.seed(seed)
+    game = Game(NullSession(1))
+    game.fill_board()
+    while n_cards is not None and len(game.layout) < n_cards:
+        game.place_three()
+    return game
+
+def selected_game(seed):
+    # A game whose yeller has selected a set, ready for check_set
+    game = new_game(seed)
+    game.deal_until_set()
+    client = game.session.clients[0]
+    game.yell_set(client)
+    for x, y in game.find_set():
+        game.select_card(game.card_at(x, y), x, y)
+    return game, client
+
+def overflowing_game(seed):
+    # 15 cards with three gaps in the main grid, so reorganize moves three
+    game = new_game(seed, 15)
+    for x, y in [(0, 0), (1, 1), (2, 2)]:
+        game.remove_card(game.card_at(x, y), x, y)
+    return game
+
+def bench_game(n=300):
+    results = {}
+    for size in BOARD_SIZES:
+        games = [new_game(seed, size) for seed in range(n)]
+        results['board_%d' % size] = dict(
+            game_has_set = time_per_call(lambda g: g.has_set(), games),
+        )
+    results['game'] = dict(
+        check_set = time_with_setup(selected_game, lambda gc: gc[0].check_set(gc[1]), n),
+        fill_board = time_with_setup(lambda seed: Game(NullSession(1)),
+                                     lambda g: g.fill_board(), n),
+        reorganize = time_with_setup(overflowing_game, lambda g: g.reorganize(), n),
+    )
+    return results
+
+class NullSender(remote.RPCSender):
+
+    def __init__(self):
+        remote.RPCSender.__init__(self, Game.SESSION_CALLS)
+
+    def send(self, msg):
+        pass
+
+class FakeSocket:
+
+    # Hands msg_generator prepared chunks from recv(); select() sees the
+    # fd of a socketpair end that always has data waiting
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.pos = 0
+        self.pair = socket.socketpair()
+        self.pair[1].send(b'x')
+
+    def fileno(self):
+        return self.pair[0].fileno()
+
+    def recv_into(self, buffer):
+        if self.pos == len(self.chunks):
+            return 0
+        chunk = self.chunks[self.pos]
+        self.pos += 1
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self):
+        for sock in self.pair:
+            sock.close()
+
+def place_frames(n, codec=protocol.JSON):
+    rng = random.Random(0)
+    return [codec.encode('place', [list(rng.choice(Card.ALL).properties),
+                                   rng.randrange(5), rng.randrange(4)], {})
+            for _ in range(n)]
+
+def bench_msg_generator(n_frames=5000, per_chunk=20):
+    frames = place_frames(n_frames)
+    chunks = [b''.join(frames[i:i + per_chunk]) for i in range(0, n_frames, per_chunk)]
+
+    def run():
+        sock = FakeSocket(chunks)
+        try:
+            for _ in remote.msg_generator({sock: None}):
+                pass
+        finally:
+            sock.close()
+    return min(timeit.repeat(run, number=1, repeat=3)) / n_frames
+
+def bench_receive(codec, n_frames=20000, chunk_size=1400):
+    # Connection's receive path, fed the way the transport feeds it: each
+    # chunk is copied into get_buffer() as recv_into would, then announced
+    data = b''.join(place_frames(n_frames, codec))
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+    def run():
+        conn = Connection(lambda msg, conn: None)
+        conn.codec = codec
+        for chunk in chunks:
+            conn.get_buffer(-1)[:len(chunk)] = chunk
+            conn.buffer_updated(len(chunk))
+    return min(timeit.repeat(run, number=1, repeat=3)) / n_frames
+
+def bench_protocol(n=20000):
+    sender = NullSender()
+    rng = random.Random(0)
+    places = [(list(rng.choice(Card.ALL).properties), rng.randrange(5), rng.randrange(4))
+              for _ in range(n)]
+    handler = remote.MsgHandler()
+    handler.register('place')(lambda owner, card, x, y: None)
+    handler.bind(None)
+    json_frames = place_frames(n)
+    binary_frames = [protocol.BINARY.encode('place', list(p), {}) for p in places]
+    return dict(protocol=dict(
+        rpc_send = time_per_call(lambda p: sender.place(*p), places),
+        json_encode = time_per_call(lambda p: protocol.JSON.encode('place', list(p), {}), places),
+        binary_encode = time_per_call(lambda p: protocol.BINARY.encode('place', list(p), {}), places),
+        json_decode = time_per_call(lambda f: protocol.JSON.next_frame(f, 0), json_frames),
+        binary_decode = time_per_call(lambda f: protocol.BINARY.next_frame(f, 0), binary_frames),
+        msg_generator = bench_msg_generator(),
+        receive_json = bench_receive(protocol.JSON),
+        receive_binary = bench_receive(protocol.BINARY),
+        msghandler_handle = time_per_call(lambda p: handler.handle('place', p, {}), places),
+    ))
+
+def bench_ui(n=2000):
+    # Imported here: ui needs curses, which headless machines may lack
+    import ui
+    rng = random.Random(0)
+    cards = [rng.choice(Card.ALL) for _ in range(n)]
+    faces = [(ui.Board.SHAPES[c.shape], ui.Board.SHADINGS[c.shading], c.number) for c in cards]
+    shaded = [(ui.CardDrawing.shade(shape, '-'), number) for shape, _, number in faces]
+    return dict(ui=dict(
+        concat_lines = time_per_call(lambda t: ui.concat_lines([t[0]] * t[1]), shaded),
+        shade = time_per_call(lambda f: ui.CardDrawing.shade(f[0], '-'), faces),
+        card_drawing_init = time_per_call(
+            lambda f: ui.CardDrawing(None, f[0], f[2], f[1]), faces),
+        build_faces = time_per_call(
+            lambda _: (ui.CardDrawing.FACES.clear(), ui.Board.build_faces()), range(50)),
+    ))
+
+def bench_timers(n=20000, pending=(1000, 50000)):
+    # Schedule and cancel should cost the same however many timers wait
+    results = {}
+    nothing = lambda: None
+    for n_pending in pending:
+        now = [0.0]
+        wheel = TimerWheel(clock=lambda: now[0])
+        rng = random.Random(n_pending)
+        for _ in range(n_pending):
+            wheel.schedule(rng.uniform(1, 600), nothing)
+        delays = [rng.uniform(1, 600) for _ in range(n)]
+        timers = []
+        row = dict(
+            schedule = time_per_call(lambda d: timers.append(wheel.schedule(d, nothing)),
+                                     delays, repeat=1),
+            cancel = time_per_call(lambda t: t.cancel(), timers, repeat=1),
+        )
+        # Then let every pending timer fire, a second at a time
+        fired = wheel.count
+        start = timeit.default_timer()
+        while wheel.count:
+            now[0] += 1
+            wheel.advance()
+        row['advance_per_fired'] = (timeit.default_timer() - start) / fired
+        results['timers_%d' % n_pending] = row
+    return results
+
+class NullTransport:
+
+    def write(self, data):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def set_write_buffer_limits(self, high):
+        pass
+
+def watcher_conns(n):
+    conns = []
+    for i in range(n):
+        conn = Connection(lambda msg, conn: None)
+        conn.transport = NullTransport()
+        conn.negotiated = True
+        conn.out_codec = protocol.BINARY if i % 2 else protocol.JSON
+        conns.append(conn)
+    return conns
+
+def bench_spectators(n_events=2000, watchers=(1, 1000), events_per_flush=10):
+    # A spectator feed costs O(1) per event plus one write per watcher per
+    # flush; players' broadcast writes every event to every socket
+    rng = random.Random(0)
+    events = [('place', [list(rng.choice(Card.ALL).properties), rng.randrange(5),
+                         rng.randrange(4)], {}) for _ in range(n_events)]
+    results = {}
+    for n in watchers:
+        conns = watcher_conns(n)
+        feed = SpectatorFeed(TimerWheel())
+        feed.watching.update(conns)
+
+        def publish():
+            for event in events:
+                feed.publish(*event)
+            feed.events = []
+
+        def flush():
+            for i in range(0, n_events, events_per_flush):
+                feed.events = events[i:i + events_per_flush]
+                feed.flush()
+
+        def broadcast():
+            for event in events:
+                protocol.broadcast(conns, *event)
+        results['spectators_%d' % n] = dict(
+            publish = min(timeit.repeat(publish, number=1, repeat=3)) / n_events,
+            flush_per_watcher = min(timeit.repeat(flush, number=1, repeat=3)) /
+                                (n_events // events_per_flush) / n,
+            broadcast = min(timeit.repeat(broadcast, number=1, repeat=3)) / n_events,
+        )
+    return results
+
+def bench_metrics(n=20000, types=30):
+    rng = random.Random(0)
+    latencies = [int(rng.lognormvariate(10, 1)) for _ in range(n)]
+    histogram = metrics.Histogram()
+    for type in range(types):
+        stats = metrics.handler_stats('benchmark', 'type_%d' % type)
+        for ns in latencies[:1000]:
+            stats.record(ns)
+    return dict(metrics=dict(
+        histogram_record = time_per_call(histogram.record, latencies),
+        histogram_p99 = time_per_call(lambda q: histogram.quantile(q), [0.99] * 1000),
+        exposition = time_per_call(lambda _: metrics.exposition(), range(20)),
+    ))
+
+def bench_set_finders(n_boards=2000):
+    results = {}
+    for size in BOARD_SIZES:
+        boards = random_boards(size, n_boards, seed=size)
+        row = dict(
+            combinations_has_set = time_per_call(combinations_has_set, boards),
+            combinations_count_sets = time_per_call(combinations_count_sets, boards),
+            has_set = time_per_call(setfinder.has_set, boards),
+            count_sets = time_per_call(setfinder.count_sets, boards),
+            find_all_sets = time_per_call(setfinder.find_all_sets, boards),
+        )
+        if setfinder.numpy is not None:
+            array = setfinder.boards_to_array(boards)
+            best = min(timeit.repeat(lambda: setfinder.batch_count_sets(array),
+                                     number=1, repeat=3))
+            row['batch_count_sets'] = best / n_boards
+        results['board_%d' % size] = row
+    return results
+
+BENCHMARKS = dict(
+    model = bench_model,
+    set_finders = bench_set_finders,
+    game = bench_game,
+    protocol = bench_protocol,
+    ui = bench_ui,
+    timers = bench_timers,
+    spectators = bench_spectators,
+    metrics = bench_metrics,
+)
+
+def run_benchmarks(names=None):
+    results = {}
+    for name in names or sorted(BENCHMARKS):
+        for group, row in BENCHMARKS[name]().items():
+            results.setdefault(group, {}).update(row)
+    return results
+
+def print_results(results):
+    for group, row in sorted(results.items()):
+        print(group)
+        for name, secs in sorted(row.items()):
+            print("  %-26s %10.2f us" % (name, secs * 1e6))
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if arg != '--json']
+    unknown = [arg for arg in args if arg not in BENCHMARKS]
+    if unknown:
+        print("Usage: python %s [--json] [%s ...]" % (sys.argv[0], ' | '.join(sorted(BENCHMARKS))))
+        exit(1)
+    # msg_generator warns each time the fake socket runs dry
+    set_level(ERROR)
+    results = run_benchmarks(args)
+    if '--json' in sys.argv[1:]:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print_results(results)
@@ -0,0 +1,65 @@
+
+class BoardState:
+
+    # What a client knows about a game, rebuilt from the host's session calls
+
+    def __init__(self):
+        # (x, y) => card properties tuple
+        self.layout = {}
+        self.selected = set()
+        self.scores = {}
+        self.yeller = None
+        self.finished = False
+
+    def apply(self, type, args, kwargs):
+        handler = getattr(self, 'on_' + type, None)
+        if handler is not None:
+            handler(*args, **kwargs)
+
+    def on_place(self, card, x, y):
+        self.layout[(x, y)] = tuple(card)
+
+    def on_remove(self, card, x, y):
+        self.layout.pop((x, y), None)
+        self.selected.discard((x, y))
+
+    def on_select(self, card, x, y):
+        self.selected.add((x, y))
+
+    def on_deselect(self, card, x, y):
+        self.selected.discard((x, y))
+
+    def on_score_update(self, scores):
+        self.scores = dict(scores)
+
+    def on_set_yelled(self, id):
+        self.yeller = id
+
+    def on_set_stolen(self, id):
+        self.yeller = id
+        self.selected.clear()
+
+    def on_resume(self):
+        self.yeller = None
+        self.selected.clear()
+
+    def on_end_game(self, scores={}, message=''):
+        if scores:
+            self.scores = dict(scores)
+        self.finished = True
+
+    def on_board_snapshot(self, cards, selected=(), scores=None, yeller=None):
+        self.layout = {(x, y): tuple(card) for card, x, y in cards}
+        self.selected = set((x, y) for x, y in selected)
+        if scores is not None:
+            self.scores = dict(scores)
+        self.yeller = yeller
+
+    def snapshot_message(self):
+        kwargs = dict(scores=self.scores)
+        if self.selected:
+            kwargs['selected'] = sorted(self.selected)
+        if self.yeller is not None:
+            kwargs['yeller'] = self.yeller
+        cards = [[card, x, y] for (x, y), card in sorted(self.layout.items())]
+        return 'board_snapshot', [cards], kwargs
@@ -0,0 +1,328 @@
+import sys
+import time
+import random
+import asyncio
+import protocol
+import setfinder
+import multiprocessing
+from remote import MsgHandler
+from transport import Connection
+from board_state import BoardState
+from model import Card
+from logger import *
+
+LOG = get_log('bots')
+
+class Reaction:
+
+    # Seconds a bot takes to act, drawn from a named distribution:
+    #   fixed:S  uniform:LO:HI  exp:MEAN  lognormal:MEDIAN:SIGMA
+
+    def __init__(self, spec):
+        self.spec = spec
+        parts = spec.split(':')
+        self.kind = parts[0]
+        self.params = [float(p) for p in parts[1:]]
+        if self.kind not in ('fixed', 'uniform', 'exp', 'lognormal'):
+            raise ValueError("Unknown reaction time distribution %s" % spec)
+
+    def sample(self, rng):
+        if self.kind == 'fixed':
+            return self.params[0]
+        if self.kind == 'uniform':
+            return rng.uniform(*self.params)
+        if self.kind == 'exp':
+            return rng.expovariate(1.0 / self.params[0])
+        median, sigma = self.params
+        return median * rng.lognormvariate(0, sigma)
+
+def percentile_ms(samples, q):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))] * 1000
+
+class BotStats:
+
+    LATENCIES = ('yell', 'check')
+
+    def __init__(self):
+        self.bots = 0
+        self.games = 0
+        self.actions = 0
+        self.sets = 0
+        self.too_late = 0
+        self.elapsed = 0
+        # yell: yell_set sent => our set_yelled; check: check_set sent => resume
+        self.latencies = {name: [] for name in self.LATENCIES}
+
+    def merge(self, other):
+        self.bots += other['bots']
+        self.games += other['games']
+        self.actions += other['actions']
+        self.sets += other['sets']
+        self.too_late += other['too_late']
+        self.elapsed = max(self.elapsed, other['elapsed'])
+        for name in self.LATENCIES:
+            self.latencies[name].extend(other['latencies'][name])
+
+    def dict(self):
+        return dict(
+            bots = self.bots,
+            games = self.games,
+            actions = self.actions,
+            sets = self.sets,
+            too_late = self.too_late,
+            elapsed = self.elapsed,
+            latencies = self.latencies,
+        )
+
+    def summary(self):
+        rtn = self.dict()
+        del rtn['latencies']
+        if self.elapsed > 0:
+            rtn['actions_per_sec'] = self.actions / self.elapsed
+            rtn['sets_per_sec'] = self.sets / self.elapsed
+        for name in self.LATENCIES:
+            samples = self.latencies[name]
+            rtn[name + '_samples'] = len(samples)
+            rtn[name + '_p50_ms'] = percentile_ms(samples, .5)
+            rtn[name + '_p99_ms'] = percentile_ms(samples, .99)
+        return rtn
+
+class Bot:
+
+    # A headless player speaking the same protocol as RemoteHost. It tracks
+    # the board from the host's messages and, after a reaction time, yells,
+    # selects a set and checks it (or asks for more cards if there is none).
+
+    H = MsgHandler('bot')
+
+    def __init__(self, stats, rng, yell_time, select_time):
+        self.stats = stats
+        self.rng = rng
+        self.yell_time = yell_time
+        self.select_time = select_time
+        self.state = BoardState()
+        self.handler = self.H.bound(self)
+        self.id = None
+        self.conn = None
+        self.loop = None
+        self.done = None
+        # The next planned action, cancelled whenever the board changes
+        self.pending = None
+        self.yelled_at = None
+        self.checked_at = None
+        self.requested = False
+
+    def connection_opened(self, conn):
+        self.conn = conn
+        self.loop = conn.loop
+        self.done = self.loop.create_future()
+        protocol.hello(conn)
+        self.send('start')
+
+    def connection_closed(self, conn):
+        self.cancel()
+        if not self.done.done():
+            self.done.set_result(None)
+
+    def message_received(self, msg, conn):
+        if protocol.client_negotiate(msg, conn):
+            return
+        self.state.apply(msg['type'], msg['args'], msg['kwargs'])
+        self.handler.handle(msg['type'], msg['args'], msg['kwargs'])
+
+    def send(self, type, *args):
+        if self.conn.closed:
+            return
+        self.stats.actions += 1
+        self.conn.send_message(type, list(args), {})
+
+    def close(self):
+        self.cancel()
+        if self.conn is not None:
+            self.conn.close()
+
+    def cancel(self):
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+
+    def later(self, delay, fn, *args):
+        self.cancel()
+        self.pending = self.loop.call_later(delay, fn, *args)
+
+    def find_set(self):
+        return setfinder.find_set({xy: Card(*props) for xy, props in self.state.layout.items()})
+
+    def plan(self):
+        # Called whenever the board changes; only acts while nobody has yelled
+        if self.state.yeller is not None or self.state.finished or self.yelled_at is not None:
+            return
+        if self.find_set() is not None:
+            self.later(self.yell_time.sample(self.rng), self.yell)
+        elif not self.requested:
+            self.later(self.yell_time.sample(self.rng), self.request_more)
+        else:
+            self.cancel()
+
+    def yell(self):
+        self.pending = None
+        self.yelled_at = time.time()
+        self.send('yell_set')
+
+    def request_more(self):
+        self.pending = None
+        self.requested = True
+        self.send('request_more')
+
+    def select_next(self, positions):
+        if not positions:
+            self.pending = None
+            self.checked_at = time.time()
+            self.send('check_set')
+            return
+        x, y = positions[0]
+        self.send('select_card', list(self.state.layout[(x, y)]), x, y)
+        self.later(self.select_time.sample(self.rng), self.select_next, positions[1:])
+
+    @H.register('client_id')
+    def handle_client_id(self, id):
+        self.id = id
+
+    @H.register('set_yelled')
+    def handle_set_yelled(self, id):
+        self.cancel()
+        if id != self.id:
+            return
+        if self.yelled_at is not None:
+            self.stats.latencies['yell'].append(time.time() - self.yelled_at)
+            self.yelled_at = None
+        # An empty selection still has to be checked to hand the board back
+        positions = self.find_set() or ()
+        self.later(self.select_time.sample(self.rng), self.select_next, list(positions))
+
+    @H.register('set_stolen')
+    def handle_set_stolen(self, id):
+        self.handle_set_yelled(id)
+
+    @H.register('too_late')
+    def handle_too_late(self, id, remaining):
+        if id == self.id:
+            self.stats.too_late += 1
+            self.yelled_at = None
+
+    @H.register('resume')
+    def handle_resume(self):
+        if self.checked_at is not None:
+            self.stats.latencies['check'].append(time.time() - self.checked_at)
+            self.stats.sets += 1
+            self.checked_at = None
+        self.yelled_at = None
+        self.plan()
+
+    @H.register('place')
+    def handle_place(self, card, x, y):
+        self.requested = False
+        self.plan()
+
+    @H.register('remove')
+    def handle_remove(self, card, x, y):
+        self.plan()
+
+    @H.register('board_snapshot')
+    def handle_board_snapshot(self, cards, selected=(), scores=None, yeller=None):
+        self.requested = False
+        self.plan()
+
+    @H.register('end_game')
+    def handle_end_game(self, scores={}, message=''):
+        if self.checked_at is not None:
+            self.stats.latencies['check'].append(time.time() - self.checked_at)
+            self.stats.sets += 1
+            self.checked_at = None
+        self.stats.games += 1
+        self.close()
+
+    @H.register('select')
+    @H.register('deselect')
+    @H.register('score_update')
+    @H.register('more_requested')
+    @H.register('session_token')
+    def handle_ignored(self, *args, **kwargs):
+        pass
+
+async def connect(loop, bot, ip, port, retries):
+    for attempt in range(retries):
+        try:
+            await loop.create_connection(
+                    lambda: Connection(bot.message_received, bot.connection_closed,
+                                       bot.connection_opened),
+                    ip, port)
+            return True
+        except OSError as e:
+            LOG.debug("Bot could not connect (%s), retrying", e)
+            await asyncio.sleep(1)
+    log_warn("Bot gave up connecting to %s:%d", ip, port)
+    return False
+
+async def run_bots(n_bots, ip='127.0.0.1', port=9999, yell_time='lognormal:1.5:0.5',
+                   select_time='uniform:0.1:0.3', seed=0, timeout=None, retries=10):
+    # Connects n_bots bots and plays until every one's game ends or timeout
+    loop = asyncio.get_event_loop()
+    stats = BotStats()
+    yell_time, select_time = Reaction(yell_time), Reaction(select_time)
+    bots = []
+    for i in range(n_bots):
+        bot = Bot(stats, random.Random(seed + i), yell_time, select_time)
+        if await connect(loop, bot, ip, port, retries):
+            bots.append(bot)
+    stats.bots = len(bots)
+    start = time.time()
+    if bots:
+        await asyncio.wait([bot.done for bot in bots], timeout=timeout)
+    stats.elapsed = time.time() - start
+    for bot in bots:
+        bot.close()
+    return stats
+
+def run_chunk(args):
+    n_bots, ip, port, yell_time, select_time, seed, timeout = args
+    return asyncio.run(run_bots(n_bots, ip, port, yell_time, select_time, seed, timeout)).dict()
+
+def load_test(n_bots, ip='127.0.0.1', port=9999, processes=1, yell_time='lognormal:1.5:0.5',
+              select_time='uniform:0.1:0.3', seed=0, timeout=None):
+    # With more than one process the bots are split evenly across a pool,
+    # each process running its share on its own event loop
+    processes = max(1, min(processes, n_bots))
+    chunks = [(n_bots // processes + (i < n_bots % processes), ip, port,
+               yell_time, select_time, seed + i * n_bots, timeout)
+              for i in range(processes)]
+    total = BotStats()
+    if processes == 1:
+        total.merge(run_chunk(chunks[0]))
+        return total.summary()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(run_chunk, chunks):
+            total.merge(result)
+    finally:
+        pool.close()
+        pool.join()
+    return total.summary()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or len(sys.argv) > 7:
+        print("Usage: python %s <# bots> [ip] [port] [# processes] [reaction time] [timeout]" % sys.argv[0])
+        print("  reaction time: fixed:S | uniform:LO:HI | exp:MEAN | lognormal:MEDIAN:SIGMA")
+        exit(1)
+    n_bots = int(sys.argv[1])
+    ip = sys.argv[2] if len(sys.argv) > 2 else '127.0.0.1'
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 9999
+    processes = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    yell_time = sys.argv[5] if len(sys.argv) > 5 else 'lognormal:1.5:0.5'
+    timeout = float(sys.argv[6]) if len(sys.argv) > 6 else None
+    summary = load_test(n_bots, ip, port, processes, yell_time, timeout=timeout)
+    for key in sorted(summary):
+        print("%s: %s" % (key, summary[key]))
@@ -1,77 +1,172 @@
 import sys
 import time
-import json
 import curses
-import socket
+import asyncio
+import metrics
+import protocol
 import ui
-from threading import Thread
-from control_queue import ControlQueue
-from remote import RPCSender, msg_generator
+from remote import RPCSender
+from transport import Connection, batch
 from logger import *
 
 init_logfile("53T_client.log")
 
+# Handler latencies and connection traffic, rewritten every METRICS_INTERVAL seconds
+METRICS_FILE = "53T_client.metrics"
+METRICS_INTERVAL = 10
+
+LOG = get_log('client')
+
 class RemoteHost(RPCSender):
 
-    CALLS = ('select_card', 'deselect_card', 'check_set', 'yell_set', 'request_more', 'start', 'disconnect')
+    # The host connection, on the same event loop as the UI: messages from
+    # the host go straight to on_message, no threads or queues in between
 
-    def __init__(self, ip, port, queue):
-        RPCSender.__init__(self, self.CALLS)
-        connected = False
+    CALLS = ('select_card', 'deselect_card', 'check_set', 'yell_set', 'request_more', 'start', 'disconnect',
+             'spectate')
+
+    RETRY_DELAY = 1
+
+    # Seconds to keep trying to get back into a game after the connection drops
+    RECONNECT_TIME = 30
 
-        while not connected:
+    def __init__(self, ip, port, on_message=None):
+        RPCSender.__init__(self, self.CALLS)
+        self.ip = ip
+        self.port = port
+        self.on_message = on_message
+        self.conn = None
+        # Messages sent before the connection is up
+        self.outbox = []
+        # From the host once seated: presented to take the seat back after a drop
+        self.token = None
+        self.deadline = None
+        self.reconnecting = None
+        self.finished = False
+        self.closing = False
+
+    async def connect(self, deadline=None):
+        # False if deadline passed before a connection was made
+        loop = asyncio.get_event_loop()
+        while True:
             try:
                 log("Attmepting to connect")
-                self.sock = socket.socket()
-                self.sock.connect((ip, port))
+                await loop.create_connection(
+                        lambda: Connection(self.message_received, self.connection_closed,
+                                           self.connection_opened),
+                        self.ip, self.port)
                 log("Connected")
-                connected = True
-            except socket.error:
-                self.sock.close()
+                return True
+            except OSError:
+                if deadline is not None and time.time() > deadline:
+                    return False
                 log("...")
-                time.sleep(1)
-        self.queue = queue
-
-    def send(self, msg):
-        self.sock.send(msg)
-
-    def receive_loop(self):
-        for msg, _ in msg_generator({self.sock: 'host'}):
-            log("Received message %s from host", msg)
-            self.queue.enqueue_obj(msg)
-        log_warn("RECEIVE LOOP EXITED!")
-        self.queue.enqueue_msg('end_game', message="Host disconnected")
-
-def run_client(stdscr, ip='127.0.0.1'):
-
-    queue = ControlQueue()
-
-    remote_host = RemoteHost(ip, 9999, queue)
+                await asyncio.sleep(self.RETRY_DELAY)
+
+    async def reconnect(self, delay):
+        await asyncio.sleep(delay)
+        if not await self.connect(self.deadline):
+            log_warn("Could not get back into the game")
+            self.token = None
+            self.connection_closed(None)
+
+    def send_message(self, type, args, kwargs):
+        if self.conn is None:
+            if type == 'disconnect':
+                # Nobody to tell: end the game here
+                self.connection_closed(None)
+                return
+            self.outbox.append((type, args, kwargs))
+            return
+        self.conn.send_message(type, args, kwargs)
+
+    def message_received(self, msg, conn):
+        if protocol.client_negotiate(msg, conn):
+            return
+        LOG.debug("Received message %s from host", msg)
+        if msg['type'] == 'session_token':
+            # Also sent on resuming: the seat is ours again
+            self.token = msg['args'][0]
+            self.deadline = None
+            return
+        if msg['type'] == 'end_game':
+            self.finished = True
+        self.on_message(msg)
+
+    def connection_opened(self, conn):
+        # One write, so whoever accepts sees the session token in the first bytes
+        with batch([conn]):
+            protocol.hello(conn)
+            if self.token is not None:
+                conn.send_message('resume_session', [self.token], {})
+            self.conn = conn
+            outbox, self.outbox = self.outbox, []
+            for type, args, kwargs in outbox:
+                conn.send_message(type, args, kwargs)
+
+    def connection_closed(self, conn):
+        if conn is not None and self.token is not None and not (self.finished or self.closing):
+            # Straight back on a drop; a host that turns us away is tried again later
+            delay = 0 if self.deadline is None else self.RETRY_DELAY
+            if self.deadline is None:
+                self.deadline = time.time() + self.RECONNECT_TIME
+            if time.time() < self.deadline:
+                # Play is held in the outbox until the seat is taken back
+                log_warn("Connection to host lost: reconnecting")
+                self.conn = None
+                self.reconnecting = asyncio.get_event_loop().create_task(self.reconnect(delay))
+                return
+        log_warn("Connection to host closed")
+        self.on_message(dict(type='end_game', args=[], kwargs=dict(message="Host disconnected")))
+
+    async def close(self):
+        self.closing = True
+        if self.reconnecting is not None:
+            self.reconnecting.cancel()
+        if self.conn is not None:
+            self.conn.close()
+            await self.conn.wait_closed()
+
+async def play(stdscr, ip, port=9999, match=None):
+    # With a match id, watches that match through a lobby's spectator port
+    loop = asyncio.get_event_loop()
 
     ui.Color.init()
     board = ui.Board(stdscr)
     board.init()
 
-    controller = ui.LocalController(board, remote_host, queue)
-
-    rtn = []
-    control_thread = Thread(target = controller.control_loop,
-                            args = (stdscr, rtn))
-
-    control_thread.start()
-
-    remote_host.start()
-    remote_host.receive_loop()
-
-    control_thread.join()
+    remote_host = RemoteHost(ip, port)
+    controller = ui.LocalController(board, remote_host, None)
+    remote_host.on_message = controller.deliver
 
+    finished = controller.run(loop, stdscr)
+    if match is None:
+        remote_host.start()
+    else:
+        remote_host.spectate(match)
+    connecting = loop.create_task(remote_host.connect())
+    metrics.dump_every(loop, METRICS_FILE, METRICS_INTERVAL)
+    try:
+        return await finished
+    finally:
+        connecting.cancel()
+        await remote_host.close()
+        metrics.dump(METRICS_FILE)
+
+def run_client(stdscr, ip='127.0.0.1', port=9999, match=None):
+    loop = asyncio.new_event_loop()
+    try:
+        rtn = loop.run_until_complete(play(stdscr, ip, port, match))
+    finally:
+        loop.close()
     log("Exiting run_client()")
-
-    if len(rtn) > 0:
-        return rtn[0]
+    return rtn
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 4:
+        print("Usage: python %s [ip] [port] [match to watch]" % sys.argv[0])
+        exit(1)
     if (sys.version_info > (3, 0)):
         print("53T Doesn't look as good with python 3 as python 2 because I can't figure out unicode!")
         print("Proceed at your own risk!")
@@ -80,6 +175,8 @@ if __name__ == '__main__':
         ip = sys.argv[1]
     else:
         ip = '127.0.0.1'
-    rtn = curses.wrapper(run_client, ip)
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 9999
+    match = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    rtn = curses.wrapper(run_client, ip, port, match)
     log("Exited...")
     print("Exited with message: " + str(rtn))
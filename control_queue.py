@@ -1,34 +1,46 @@
 try:
-    from queue import Queue
+    from queue import Queue, Empty
 except:
     # Python 3 changed capitalization O_o
-    from Queue import Queue
+    from Queue import Queue, Empty
 from logger import *
+import metrics
 import json
 
+LOG = get_log('queue')
+
 class ControlQueue:
 
-    def __init__(self):
+    def __init__(self, name='control'):
         self.queue = Queue()
         self.exiting = False
+        # Messages waiting, read whenever metrics are
+        metrics.gauge('queue_depth', self.queue.qsize, queue=name)
 
     def signal_exit(self):
-        log("Exit signaled in queue")
+        LOG.debug("Exit signaled in queue")
         self.exiting = True
 
+    def empty(self):
+        return self.queue.empty()
+
     def enqueue_obj(self, obj):
-        log("Putting object %s in queue", obj)
+        LOG.debug("Putting object %s in queue", obj)
         self.queue.put(obj)
 
     def enqueue_msg(self, type, *args, **kwargs):
         rtn = dict(type = type, args=args, kwargs=kwargs)
-        log("Putting message %s in queue", rtn)
+        LOG.debug("Putting message %s in queue", rtn)
         self.queue.put(rtn)
 
-    def dequeue(self):
-        log("Attempting dequeue")
-        msg = self.queue.get(True)
-        log("Dequeueing message %s", msg)
+    def dequeue(self, timeout=None):
+        # Returns None if nothing arrives within timeout seconds
+        LOG.debug("Attempting dequeue")
+        try:
+            msg = self.queue.get(True, timeout)
+        except Empty:
+            return None
+        LOG.debug("Dequeueing message %s", msg)
         return msg
 
 
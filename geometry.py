@@ -0,0 +1,75 @@
+import heapq
+
+class Geometry:
+
+    # Board positions, numbered as slots in dealing order: the main grid row
+    # by row, then each extra column top to bottom
+
+    def __init__(self, shape=(3, 4), extra_columns=2, extra_rows=3):
+        cols, rows = shape
+        self.shape = shape
+        self.positions = [(x, y) for y in range(rows) for x in range(cols)]
+        self.n_normal = len(self.positions)
+        for ex_x in range(extra_columns):
+            self.positions.extend((cols + ex_x, y) for y in range(extra_rows))
+        self.n_slots = len(self.positions)
+        self.n_cols = cols + extra_columns
+        self.n_rows = max(rows, extra_rows)
+        # (x, y) => slot
+        self.slots = {xy: slot for slot, xy in enumerate(self.positions)}
+
+    def xy(self, slot):
+        return self.positions[slot]
+
+    def slot(self, x, y):
+        return self.slots.get((x, y))
+
+    def cell_at(self, px, py, origin_x, origin_y, width, height):
+        # The position whose width x height cell, laid out from the origin,
+        # has (px, py) strictly inside it; (None, None) if there is none
+        cx, dx = divmod(px - origin_x, width)
+        cy, dy = divmod(py - origin_y, height)
+        if dx == 0 or dy == 0 or (cx, cy) not in self.slots:
+            return None, None
+        return cx, cy
+
+# The board 53T has always used: 3x4, plus two extra columns of three
+STANDARD = Geometry()
+
+class SlotAllocator:
+
+    # Hands out the lowest free slot. Slots freed or claimed out of order
+    # leave stale heap entries, which are skipped when they reach the top.
+
+    def __init__(self, geometry):
+        self.geometry = geometry
+        self.clear()
+
+    def clear(self):
+        self.free = [True] * self.geometry.n_slots
+        self.heap = list(range(self.geometry.n_slots))
+        self.used = 0
+
+    def lowest_free(self):
+        while self.heap and not self.free[self.heap[0]]:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return self.heap[0]
+
+    def take(self):
+        slot = self.lowest_free()
+        if slot is not None:
+            self.claim(slot)
+        return slot
+
+    def claim(self, slot):
+        if self.free[slot]:
+            self.free[slot] = False
+            self.used += 1
+
+    def release(self, slot):
+        if not self.free[slot]:
+            self.free[slot] = True
+            self.used -= 1
+            heapq.heappush(self.heap, slot)
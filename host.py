@@ -1,64 +1,76 @@
 from model import Card, Deck
 from logger import *
-import itertools
+from geometry import STANDARD, SlotAllocator
+import setfinder
 import time
 import copy
 
 def is_set(a, b, c):
-    if a.third(b) == c:
-        log("Cards are a set!")
-        return True
-    else:
-        log("Cards are not a set: needed %s, gave %s", a.third(b), c)
-        return False
+    return Card.THIRD[a.id][b.id] == c.id
 
 class Game:
 
-    BOARD_SHAPE = (3, 4)
+    GEOMETRY = STANDARD
+    BOARD_SHAPE = GEOMETRY.shape
 
-    MAX_CARDS = 18
-    MAX_NORMAL = BOARD_SHAPE[0] * BOARD_SHAPE[1]
+    MAX_CARDS = GEOMETRY.n_slots
+    MAX_NORMAL = GEOMETRY.n_normal
 
     DELAY=.1
 
     SET_TIMEOUT = 5
 
-    SESSION_CALLS = ('remove', 'select', 'deselect', 'place', 'set_yelled', 'score_update',
-                     'set_stolen', 'too_late', 'end_game', 'resume', 'more_requested')
+    # Deal three more cards whenever the board is left without a set
+    AUTO_DEAL = False
 
-    def __init__(self, session):
+    SESSION_CALLS = ('remove', 'select', 'deselect', 'place', 'set_yelled', 'score_update',
+                     'set_stolen', 'too_late', 'end_game', 'resume', 'more_requested',
+                     'board_snapshot')
+
+    def __init__(self, session, geometry=None, timers=None):
+        if geometry is not None:
+            self.GEOMETRY = geometry
+            self.BOARD_SHAPE = geometry.shape
+            self.MAX_CARDS = geometry.n_slots
+            self.MAX_NORMAL = geometry.n_normal
+        # Free board positions, lowest (earliest in dealing order) first
+        self.slots = SlotAllocator(self.GEOMETRY)
         self.deck = Deck()
         self.deck.shuffle()
         self.layout = dict()
         self.selected = dict()
+        # Every set currently on the board, kept in step with self.layout
+        self.set_index = setfinder.SetIndex()
 
         self.requests = {}
         self.session = session
         self.scores = { client.id : 0 for client in self.session.clients }
         self.current_yeller = None
+        # A TimerWheel that expires yells on time; without one a yell only
+        # expires when somebody else yells after its deadline
+        self.timers = timers
+        self.yell_timer = None
+        # Expired timers arrive here as messages from the client concerned,
+        # so the host can route them through its own dispatch and journal
+        self.timer_sink = self.handle_timer
         self.reset_requests()
 
     def has_set(self):
-        for c1, c2, c3 in itertools.combinations(self.layout.values(), 3):
-            if c1.third(c2) == c3:
-                return True
-        return False
+        return self.set_index.has_set()
+
+    def count_sets(self):
+        return self.set_index.count_sets()
+
+    def find_set(self):
+        return self.set_index.find_set()
+
+    def find_all_sets(self):
+        return self.set_index.find_all_sets()
 
     def reset_requests(self):
         for id in self.session.client_ids():
             self.requests[id] = False
 
-    @classmethod
-    def iterxy(cls):
-        for y in range(cls.BOARD_SHAPE[1]):
-            for x in range(cls.BOARD_SHAPE[0]):
-                yield x,y
-        for ex_x in range(3):
-            yield cls.BOARD_SHAPE[0], ex_x
-        for ex_x in range(3):
-            yield cls.BOARD_SHAPE[0] + 1, ex_x
-
-
     def request_more(self, client):
         self.requests[client.id] = True
         num_requested = len([r for r in self.requests.values() if r])
@@ -67,24 +79,53 @@ class Game:
             self.place_three()
             self.reset_requests()
 
+    def handle_timer(self, msg, client):
+        return getattr(self, msg['type'])(client)
+
+    def timer_fired(self, type, client):
+        self.yell_timer = None
+        return self.timer_sink(dict(type=type, args=[], kwargs={}), client)
+
+    def start_yell(self, client):
+        self.cancel_timers()
+        self.current_yeller = (client, time.time() + self.SET_TIMEOUT)
+        self.requests[client.id] = False
+        if self.timers is not None:
+            self.yell_timer = self.timers.schedule(self.SET_TIMEOUT, self.timer_fired,
+                                                   'yell_expired', client)
+
+    def cancel_timers(self):
+        if self.yell_timer is not None:
+            self.yell_timer.cancel()
+            self.yell_timer = None
+
     def yell_set(self, client):
         if self.current_yeller is None:
             self.session.set_yelled(client.id)
-            self.current_yeller = (client, time.time() + self.SET_TIMEOUT)
-            self.requests[client.id] = False
+            self.start_yell(client)
         else:
             yeller, timeout = self.current_yeller
-            if self.current_yeller != client:
+            if yeller != client:
                 if time.time() > timeout:
                     self.deselect_all()
                     self.scores[yeller.id] -= 1
                     self.session.score_update(self.scores)
                     self.session.set_stolen(client.id)
-                    self.current_yeller = (client, time.time() + self.TIMEOUT)
-                    self.requests[client.id] = False
+                    self.start_yell(client)
                 else:
                     self.session.too_late(client.id, int(timeout - time.time()))
 
+    def yell_expired(self, client):
+        # The yeller ran out of time: they lose a point and play resumes
+        if self.current_yeller is None or self.current_yeller[0] != client:
+            return
+        self.cancel_timers()
+        self.deselect_all()
+        self.scores[client.id] -= 1
+        self.session.score_update(self.scores)
+        self.current_yeller = None
+        self.session.resume()
+
     def deselect_all(self):
         selected = copy.deepcopy(self.selected)
         for (x,y), card in selected.items():
@@ -96,10 +137,10 @@ class Game:
         return self.deck.cards_remaining() > 0
 
     def next_spot(self):
-        for x, y in self.iterxy():
-            if self.card_at(x, y) is None:
-                return x, y
-        return None, None
+        slot = self.slots.lowest_free()
+        if slot is None:
+            return None, None
+        return self.GEOMETRY.xy(slot)
 
     def card_at(self, x, y):
         return self.layout.get((x,y), None)
@@ -120,6 +161,8 @@ class Game:
         if (x, y) in self.selected:
             del self.selected[(x, y)]
         del self.layout[(x,y)]
+        self.set_index.remove((x, y))
+        self.slots.release(self.GEOMETRY.slot(x, y))
 
     def select_card(self, card, x, y):
         if not self.valid_card(card, x, y):
@@ -129,6 +172,7 @@ class Game:
         self.selected[(x,y)] = card
 
     def check_set(self, client):
+        self.cancel_timers()
         if len(self.selected) == 3 and is_set(*self.selected.values()):
             self.scores[client.id] += 1
             self.session.score_update(self.scores)
@@ -138,9 +182,12 @@ class Game:
             self.selected.clear()
             self.fill_board()
             self.reorganize()
-            log("{} cards remaining".format(self.deck.cards_remaining()))
-            log("Set present? {}".format(self.has_set()))
-            if self.deck.cards_remaining() == 0 and not self.has_set():
+            if self.AUTO_DEAL:
+                self.deal_until_set()
+            set_present = self.has_set()
+            log("%d cards remaining", self.deck.cards_remaining())
+            log("Set present? %s", set_present)
+            if self.deck.cards_remaining() == 0 and not set_present:
                 self.session.end_game(self.scores)
                 return True
         else:
@@ -165,47 +212,106 @@ class Game:
             del self.selected[(x,y)]
         self.session.deselect(card.properties, x, y)
 
-    def place_card(self, card):
+    def place_card(self, card, announce=True):
         if len(self.layout) == self.MAX_CARDS:
             log_warn("Attempted to place more than MAX_CARDS")
             return
-        x, y = self.next_spot()
-        if x is None:
+        slot = self.slots.take()
+        if slot is None:
             log_error("MAX_CARDS not placed but no next_spot available")
             return
+        x, y = self.GEOMETRY.xy(slot)
         self.layout[(x,y)] = card
-        self.session.place(card.properties, x, y)
+        self.set_index.add((x, y), card)
+        if announce:
+            self.session.place(card.properties, x, y)
         #time.sleep(self.DELAY)
 
-    def place_next(self):
+    def place_next(self, announce=True):
         if len(self.layout) == self.MAX_CARDS:
             log_warn("Cannot place more than %d cards", self.MAX_CARDS)
             return
         card = self.deck.draw()
-        self.place_card(card)
+        self.place_card(card, announce)
 
     def fill_board(self):
+        # The initial deal goes out as one snapshot rather than a place per card
+        initial = len(self.layout) == 0
         while self.cards_remain() and len(self.layout) < self.MAX_NORMAL:
-            self.place_next()
-
-    def iloc(self, i):
-        for idx, (x,y) in enumerate(self.iterxy()):
-            if idx == i:
-                return x, y, self.card_at(x,y)
+            self.place_next(not initial)
+        if initial and len(self.layout) > 0:
+            self.send_snapshot()
+
+    def snapshot_cards(self):
+        return [[card.properties, x, y] for (x, y), card in self.layout.items()]
+
+    def snapshot_message(self, selected=True, scores=True, yeller=True):
+        kwargs = {}
+        if selected and len(self.selected) > 0:
+            kwargs['selected'] = list(self.selected)
+        if scores:
+            kwargs['scores'] = self.scores
+        if yeller and self.current_yeller is not None:
+            kwargs['yeller'] = self.current_yeller[0].id
+        return 'board_snapshot', [self.snapshot_cards()], kwargs
+
+    def send_snapshot(self, selected=False, scores=False):
+        _, args, kwargs = self.snapshot_message(selected, scores)
+        self.session.board_snapshot(*args, **kwargs)
+
+    def deal_until_set(self):
+        while not self.has_set() and self.cards_remain() and \
+                len(self.layout) + 3 <= self.MAX_CARDS:
+            self.place_three()
 
     def reorganize(self):
-        for i in range(self.MAX_CARDS)[::-1]:
-            if i < self.MAX_NORMAL:
+        # Moves cards from the extra columns into lower free slots, last first
+        for slot in range(self.MAX_CARDS - 1, self.MAX_NORMAL - 1, -1):
+            free = self.slots.lowest_free()
+            if free is None or free >= slot:
                 return
-            x, y, c = self.iloc(i)
+            x, y = self.GEOMETRY.xy(slot)
+            c = self.card_at(x, y)
             if c is None:
                 continue
-            else:
-                log("Reorganizing card %d", i)
-                self.remove_card(c, x, y)
-                self.place_card(c)
-                updated = True
+            log("Reorganizing card %d", slot)
+            self.remove_card(c, x, y)
+            self.place_card(c)
+
+    def dump_state(self):
+        yeller, deadline = self.current_yeller if self.current_yeller else (None, None)
+        return dict(
+            deck = [card.id for card in self.deck.deck],
+            layout = [(card.id, x, y) for (x, y), card in self.layout.items()],
+            selected = list(self.selected),
+            scores = sorted(self.scores.items()),
+            requests = sorted(id for id, requested in self.requests.items() if requested),
+            yeller = yeller.id if yeller is not None else None,
+            yell_deadline = deadline,
+        )
+
+    def load_state(self, state):
+        # Session calls are not made: the caller resyncs clients afterwards
+        self.deck.deck = [Card.from_id(id) for id in state['deck']]
+        self.layout.clear()
+        self.set_index.clear()
+        self.slots.clear()
+        self.selected.clear()
+        for id, x, y in state['layout']:
+            card = Card.from_id(id)
+            self.layout[(x, y)] = card
+            self.set_index.add((x, y), card)
+            self.slots.claim(self.GEOMETRY.slot(x, y))
+        for x, y in state['selected']:
+            self.selected[(x, y)] = self.layout[(x, y)]
+        self.scores = dict(state['scores'])
+        self.requests = {id: id in state['requests'] for id in self.session.client_ids()}
+        self.current_yeller = None
+        for client in self.session.clients:
+            if client.id == state['yeller']:
+                self.current_yeller = (client, state['yell_deadline'])
 
     def disconnect(self, client):
+        self.cancel_timers()
         self.session.end_game(self.scores, "Player {} exited early -- ".format(client.id))
         return True
@@ -1,37 +1,52 @@
 import sys
 import host
-import socket
-import json
-import select
-from remote import RPCSender, MsgHandler,  msg_generator
-from control_queue import ControlQueue
+import secrets
+import asyncio
+import metrics
+import protocol
+from remote import RPCSender, MsgHandler
+from transport import Connection, batch
+from journal import Journal, JournalSession, recover
+from replay import ArchiveWriter, ArchiveSession, unused_path
+from timers import TimerWheel
+from spectators import SpectatorFeed
 from host import Game
 from logger import *
 from model import *
 
+LOG = get_log('host')
+
 
 class RemoteClient:
 
-    def __init__(self, sock, id):
-        self.sock = sock
+    def __init__(self, conn, id):
+        self.conn = conn
         self.id = id
+        # Set by the client's first message, which says whether it negotiates
+        self.ready = False
+        # Presented in resume_session to take this seat back after a drop
+        self.token = secrets.token_hex(8)
+        # Ends the game unless the player reconnects first
+        self.grace_timer = None
 
-        self.send(json.dumps(dict(type="client_id", args=[id], kwargs={}))+ '~')
+        self.greet()
 
-    def send(self, msg):
-        self.sock.send(msg)
-        log("Sent message %s", msg)
+    def greet(self):
+        self.conn.send_message("client_id", [self.id], {})
+        self.conn.send_message("session_token", [self.token], {})
 
-    def recv(self):
-        return self.sock.recv(2048)
+    def send(self, msg):
+        self.conn.send(msg)
+        LOG.debug("Sent message %s", msg)
 
 class HostReceiver(object):
 
-    H = MsgHandler()
+    H = MsgHandler('host')
 
-    def __init__(self, game):
+    def __init__(self, game, journal=None):
         self.game = game
-        self.H.bind(self)
+        self.journal = journal
+        self.handler = self.H.bound(self)
 
     @H.register('start')
     def handle_start(self, client):
@@ -40,11 +55,22 @@ class HostReceiver(object):
 
     @H.register('select_card')
     def handle_select(self, client, card, x, y):
-        return self.game.select_card(Card(*card), x, y)
+        card = self.known_card(card)
+        if card is not None:
+            return self.game.select_card(card, x, y)
 
     @H.register('deselect_card')
     def handle_deselect(self, client, card, x, y):
-        return self.game.deselect_card(Card(*card), x, y)
+        card = self.known_card(card)
+        if card is not None:
+            return self.game.deselect_card(card, x, y)
+
+    def known_card(self, properties):
+        # Ignored like any other invalid card, rather than ending the game
+        card = Card.lookup(properties)
+        if card is None:
+            log_warn("Not a card: %s", properties)
+        return card
 
     @H.register('check_set')
     def handle_check(self, client):
@@ -58,66 +84,329 @@ class HostReceiver(object):
     def handle_yell(self, client):
         return self.game.yell_set(client)
 
+    @H.register('yell_expired')
+    def handle_yell_expired(self, client):
+        return self.game.yell_expired(client)
+
     @H.register('disconnect')
     def handle_disconnect(self, client):
         return self.game.disconnect(client)
 
+    def handle_message(self, msg, client):
+        if self.journal is None:
+            return self.handler.handle(msg['type'], [client] + msg['args'], msg['kwargs'])
+        self.journal.inbound(client.id, msg)
+        rtn = self.handler.handle(msg['type'], [client] + msg['args'], msg['kwargs'])
+        if rtn == True:
+            self.journal.finish()
+        else:
+            self.journal.event_done(self.game)
+        return rtn
+
     def control_loop(self, session):
-        for msg, client in session.generate_messages():
-            rtn = self.H.handle(msg['type'], [client] + msg['args'], msg['kwargs'])
-            if rtn == True:
-                return True
+        return session.run(self.handle_message)
 
 class RemoteSession(RPCSender):
 
     NUM_PLAYERS = 2
+    # Seconds a player whose connection drops has to reconnect before the
+    # game ends; the others play on meanwhile. 0 ends it at once.
+    RECONNECT_GRACE = 30
 
-    def __init__(self, ip, port, num_players=NUM_PLAYERS):
+    def __init__(self, ip, port, num_players=NUM_PLAYERS,
+                 outbound_limit=None, overflow_policy=None, spectator_port=None,
+                 grace=None, metrics_port=None):
         RPCSender.__init__(self, Game.SESSION_CALLS)
         self.port = port
         self.num_clients = num_players
-        #create an INET, STREAMing socket
-        serversocket = socket.socket(
-                socket.AF_INET, socket.SOCK_STREAM)
-        serversocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        serversocket.bind((ip, port))
-        log("Bound to %d", port)
-        #become a server socket
-        serversocket.listen(10)
+        self.grace = grace if grace is not None else self.RECONNECT_GRACE
+        self.loop = asyncio.new_event_loop()
+        self.timers = TimerWheel()
+        self.timers.attach(self.loop)
+        # Returns the message that resyncs a client whose queue overflowed
+        self.snapshot_source = None
+        # Watchers on spectator_port; they are not clients and never block them
+        self.spectators = SpectatorFeed(self.timers, self.current_snapshot)
+        self.spectator_server = None
+        if spectator_port is not None:
+            self.spectator_server = self.loop.run_until_complete(self.loop.create_server(
+                    lambda: Connection(self.spectator_message, self.spectators.remove),
+                    ip, spectator_port, reuse_address=True))
+            log("Spectators on %d", spectator_port)
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = self.loop.run_until_complete(metrics.serve(ip, metrics_port))
 
         self.clients = []
-        for id in range(num_players):
-            log("Listening...")
-            conn, _ = serversocket.accept()
-            log("Accepted connection!")
-            self.clients.append(RemoteClient(conn, id + 1))
+        # connection => RemoteClient
+        self.conn_clients = {}
+        # session token => RemoteClient
+        self.tokens = {}
+        # Connections made once the game is full: only resume_session is heard
+        self.resuming = set()
+        # Messages received before run() installs a handler
+        self.pending = []
+        self.handler = None
+        self.done = self.loop.create_future()
+        self.all_ready = self.loop.create_future()
+
+        self.server = self.loop.run_until_complete(self.loop.create_server(
+                lambda: Connection(self.message_received, self.connection_closed,
+                                   self.connection_opened,
+                                   outbound_limit, overflow_policy),
+                ip, port, reuse_address=True))
+        log("Bound to %d", port)
+        log("Listening...")
+        # Wait for every player to connect and speak, so the game knows
+        # which clients negotiated before it sends them anything
+        self.loop.run_until_complete(self.all_ready)
+        if self.grace == 0:
+            # No more players and no reconnects: stop accepting
+            self.server.close()
+
+    def connection_opened(self, conn):
+        if len(self.clients) == self.num_clients:
+            if self.grace == 0:
+                log_warn("Rejecting connection: game is full")
+                conn.close()
+            else:
+                self.resuming.add(conn)
+            return
+        log("Accepted connection!")
+        # The lowest seat free: one may have been given up before the start
+        taken = set(client.id for client in self.clients)
+        id = min(id for id in range(1, self.num_clients + 1) if id not in taken)
+        client = RemoteClient(conn, id)
+        conn.snapshot_source = self.current_snapshot
+        self.clients.append(client)
+        self.clients.sort(key=lambda client: client.id)
+        self.conn_clients[conn] = client
+        self.tokens[client.token] = client
+
+    def resume_message(self, msg, conn):
+        if protocol.host_negotiate(msg, conn):
+            return
+        self.resuming.discard(conn)
+        client = None
+        if msg['type'] == 'resume_session' and msg['args']:
+            client = self.tokens.get(msg['args'][0])
+        if client is None or self.done.done():
+            log_warn("Rejecting connection: game is full")
+            conn.close()
+            return
+        self.reattach(client, conn)
+
+    def reattach(self, client, conn):
+        # The player gets their seat back and one snapshot of the game as
+        # it stands, and their old connection (if somehow still up) is dropped
+        old = client.conn
+        del self.conn_clients[old]
+        old.close()
+        if client.grace_timer is not None:
+            client.grace_timer.cancel()
+            client.grace_timer = None
+        client.conn = conn
+        conn.snapshot_source = self.current_snapshot
+        self.conn_clients[conn] = client
+        log("Player %d reconnected", client.id)
+        with batch([conn]):
+            client.greet()
+            if self.snapshot_source is not None:
+                conn.send_message(*self.snapshot_source())
+
+    def client_ready(self, client):
+        client.ready = True
+        if len(self.clients) == self.num_clients and \
+                all(c.ready for c in self.clients) and not self.all_ready.done():
+            self.all_ready.set_result(True)
+
+    def message_received(self, msg, conn):
+        client = self.conn_clients.get(conn)
+        if client is None:
+            if conn in self.resuming:
+                self.resume_message(msg, conn)
+            return
+        if not client.ready:
+            self.client_ready(client)
+        if protocol.host_negotiate(msg, conn):
+            return
+        if self.handler is None:
+            self.pending.append((msg, client))
+        else:
+            self.dispatch(msg, client)
+
+    def connection_closed(self, conn):
+        self.resuming.discard(conn)
+        client = self.conn_clients.get(conn)
+        if client is None or self.done.done():
+            return
+        if not self.all_ready.done():
+            # Still waiting for players: the next to connect takes the seat
+            log_warn("Player %d left before the game started", client.id)
+            self.release_seat(client)
+            return
+        if self.grace > 0:
+            log_warn("Player %d disconnected; holding their seat for %d seconds",
+                     client.id, self.grace)
+            client.grace_timer = self.timers.schedule(self.grace, self.grace_expired, client)
+            return
+        log_warn("Player %d disconnected", client.id)
+        self.message_received(dict(type='disconnect', args=[], kwargs={}), conn)
+
+    def release_seat(self, client):
+        self.clients.remove(client)
+        del self.conn_clients[client.conn]
+        del self.tokens[client.token]
+        self.pending = [(msg, sender) for msg, sender in self.pending if sender is not client]
+
+    def grace_expired(self, client):
+        client.grace_timer = None
+        log_warn("Player %d did not reconnect", client.id)
+        self.dispatch(dict(type='disconnect', args=[], kwargs={}), client)
+
+    def current_snapshot(self):
+        if self.snapshot_source is not None:
+            return self.snapshot_source()
+
+    def spectator_message(self, msg, conn):
+        # Spectators are read-only: their first message, negotiation or not,
+        # just says they are ready to watch
+        protocol.host_negotiate(msg, conn)
+        self.spectators.add(conn)
+
+    def dispatch(self, msg, client):
+        if self.done.done():
+            return
+        try:
+            # Everything the handler sends goes out in one write per client
+            with batch(client.conn for client in self.clients):
+                rtn = self.handler(msg, client)
+        except Exception as e:
+            self.done.set_exception(e)
+            return
+        if rtn == True:
+            self.done.set_result(True)
+
+    def run(self, handler):
+        # Serves messages from every client until handler returns True
+        self.handler = handler
+        pending, self.pending = self.pending, []
+        for msg, client in pending:
+            self.dispatch(msg, client)
+        try:
+            return self.loop.run_until_complete(self.done)
+        finally:
+            self.close()
+
+    # Long enough for a lagging peer's queue to drain (or be given up on)
+    CLOSE_TIMEOUT = Connection.DRAIN_TIMEOUT + 1
+
+    def close(self):
+        self.server.close()
+        for conn in self.resuming:
+            conn.close()
+        for client in self.clients:
+            if client.grace_timer is not None:
+                client.grace_timer.cancel()
+        if self.spectator_server is not None:
+            self.spectator_server.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        watchers = list(self.spectators.watching)
+        self.spectators.close()
+        for client in self.clients:
+            client.conn.close()
+        # Let the transports flush and close before the loop goes away
+        for conn in [client.conn for client in self.clients] + watchers:
+            self.loop.run_until_complete(conn.wait_closed(self.CLOSE_TIMEOUT))
+        self.loop.close()
 
     def client_ids(self):
         for client in self.clients:
             yield client.id
 
-    def generate_messages(self):
-        sock_map = {c.sock : c for c in self.clients}
-        for msg, client in  msg_generator(sock_map):
-            yield msg, client
-
     def send(self, msg):
         for client in self.clients:
             client.send(msg)
 
-def run_host(ip='127.0.0.1', num_players=2):
+    def send_message(self, type, args, kwargs):
+        protocol.broadcast([client.conn for client in self.clients], type, args, kwargs)
+        self.spectators.publish(type, args, kwargs)
+        LOG.debug("Sent message %s %s", type, args)
+
+def optional(arg, convert=str):
+    # An optional command-line argument: '-' (or '') skips it, so later
+    # ones can still be given
+    if arg is None or arg in ('-', ''):
+        return None
+    return convert(arg)
+
+def run_host(ip='127.0.0.1', num_players=2, journal_path=None, archive_path=None,
+             spectator_port=None, metrics_port=None):
 
     log("Here!")
-    session = RemoteSession(ip, 9999, int(num_players))
-    game = host.Game(session)
+    num_players = int(num_players)
+    journal_path = optional(journal_path)
+    archive_path = optional(archive_path)
+    spectator_port = optional(spectator_port, int)
+    metrics_port = optional(metrics_port, int)
+    session = RemoteSession(ip, 9999, num_players, spectator_port=spectator_port,
+                            metrics_port=metrics_port)
+
+    journal = None
+    game = None
+    if journal_path is not None:
+        game = recover(journal_path, num_players)
+        journal = Journal(journal_path, truncate=game is None)
+
+    # What the game talks to: the session, wrapped by the archive if any
+    game_session = session
+    archive = None
+    if archive_path is not None:
+        if game is not None:
+            # The archive there holds the game up to the crash: carry it on
+            try:
+                archive = ArchiveWriter(archive_path, resume=True)
+            except ValueError as e:
+                resumed_path = unused_path(archive_path)
+                log_warn("Cannot continue archive (%s): recording the resumed game to %s",
+                         e, resumed_path)
+                archive_path = resumed_path
+        if archive is None:
+            archive = ArchiveWriter(archive_path)
+        game_session = ArchiveSession(session, archive)
+
+    if game is None:
+        game = host.Game(game_session, timers=session.timers)
+    else:
+        # A crash interrupts whoever was selecting; everyone gets a fresh board
+        game.current_yeller = None
+        game.selected.clear()
+        game.session = game_session
+        game.timers = session.timers
+        with batch(client.conn for client in session.clients):
+            game.send_snapshot(selected=True, scores=True)
+
+    if journal is not None:
+        game.session = JournalSession(game.session, journal)
+        journal.snapshot(game)
+        journal.flush()
+    session.snapshot_source = game.snapshot_message
 
-    receiver = HostReceiver(game)
+    receiver = HostReceiver(game, journal)
+    # Expiries are handled like client messages, so they are journaled too
+    game.timer_sink = session.dispatch
 
-    receiver.control_loop(session)
+    try:
+        receiver.control_loop(session)
+    finally:
+        if archive is not None:
+            archive.close()
 
 if __name__ == '__main__':
     init_stdoutlog()
-    if len(sys.argv) > 3 :
-        print("Usage: python %s [ip] [# players]" % sys.argv[0])
+    if len(sys.argv) > 7 :
+        print("Usage: python %s [ip] [# players] [journal file] [archive file] [spectator port] [metrics port]" % sys.argv[0])
+        print("       ('-' for any of the last four leaves it out)")
         exit(1)
     run_host(*sys.argv[1:])
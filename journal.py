@@ -0,0 +1,230 @@
+import os
+import time
+import zlib
+import struct
+import protocol
+from host import Game
+from simulator import NullSession
+from logger import *
+
+# Append-only game journal. Each record is
+#   !I payload length, !I crc32 of kind + payload, !B kind, payload
+# so a torn write at the tail is detected and ignored on recovery.
+# INBOUND and OUTBOUND payloads are binary-protocol frames (inbound ones
+# prefixed by the sending client's id); SNAPSHOT payloads are a packed
+# Game.dump_state(); END marks a game that finished normally.
+
+INBOUND = 1
+OUTBOUND = 2
+SNAPSHOT = 3
+END = 4
+
+RECORD_HEADER = struct.Struct('!IIB')
+
+CODEC = protocol.BINARY
+
+def pack_state(state):
+    out = [struct.pack('!B', len(state['deck'])), bytes(bytearray(state['deck']))]
+    out.append(struct.pack('!B', len(state['layout'])))
+    out.extend(struct.pack('!BB', id, x << 4 | y) for id, x, y in state['layout'])
+    out.append(struct.pack('!B', len(state['selected'])))
+    out.extend(struct.pack('!B', x << 4 | y) for x, y in state['selected'])
+    out.append(struct.pack('!B', len(state['scores'])))
+    out.extend(struct.pack('!Bi?', id, score, id in state['requests'])
+               for id, score in state['scores'])
+    yeller = state['yeller']
+    out.append(struct.pack('!Bd', yeller if yeller is not None else 0,
+                           state['yell_deadline'] or 0))
+    return b''.join(out)
+
+def unpack_state(data):
+    offset = 0
+    def take(fmt):
+        nonlocal offset
+        rtn = struct.unpack_from(fmt, data, offset)
+        offset += struct.calcsize(fmt)
+        return rtn
+
+    n, = take('!B')
+    deck = list(bytearray(data[offset:offset + n]))
+    offset += n
+    layout = []
+    for _ in range(take('!B')[0]):
+        id, xy = take('!BB')
+        layout.append((id, xy >> 4, xy & 0xf))
+    selected = []
+    for _ in range(take('!B')[0]):
+        xy, = take('!B')
+        selected.append((xy >> 4, xy & 0xf))
+    scores, requests = [], []
+    for _ in range(take('!B')[0]):
+        id, score, requested = take('!Bi?')
+        scores.append((id, score))
+        if requested:
+            requests.append(id)
+    yeller, deadline = take('!Bd')
+    return dict(deck=deck, layout=layout, selected=selected, scores=scores,
+                requests=requests, yeller=yeller or None,
+                yell_deadline=deadline if yeller else None)
+
+def read_records(path):
+    # Yields (kind, payload, end offset) up to the first torn or corrupt record
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset < len(data):
+        if offset + RECORD_HEADER.size > len(data):
+            log_warn("Journal %s ends in a torn record at byte %d", path, offset)
+            return
+        length, crc, kind = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(bytes([kind]) + payload) & 0xffffffff != crc:
+            log_warn("Journal %s ends in a torn record at byte %d", path, offset)
+            return
+        offset = start + length
+        yield kind, payload, offset
+
+def decode_message(frame):
+    msg, _ = CODEC.next_frame(frame, 0)
+    return msg
+
+class Journal:
+
+    # Records are buffered and written + fsync'd together by flush(), which
+    # the host calls once per handled inbound event
+
+    SNAPSHOT_EVERY = 64
+    # Rewrite the file from the latest snapshot once it grows past this
+    COMPACT_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, path, fsync=True, truncate=False):
+        self.path = path
+        self.fsync = fsync
+        self.file = open(path, 'wb' if truncate else 'ab')
+        self.pending = []
+        self.events_since_snapshot = 0
+
+    def append(self, kind, payload):
+        crc = zlib.crc32(bytes([kind]) + payload) & 0xffffffff
+        self.pending.append(RECORD_HEADER.pack(len(payload), crc, kind))
+        self.pending.append(payload)
+
+    def inbound(self, client_id, msg):
+        try:
+            frame = CODEC.encode(msg['type'], msg['args'], msg['kwargs'])
+        except protocol.FrameTooLarge as e:
+            log_warn("Not journaling inbound message: %s", e)
+            return
+        self.append(INBOUND, struct.pack('!B', client_id) + frame)
+
+    def outbound(self, type, args, kwargs):
+        try:
+            self.append(OUTBOUND, CODEC.encode(type, args, kwargs))
+        except protocol.FrameTooLarge as e:
+            log_warn("Not journaling outbound message: %s", e)
+
+    def snapshot(self, game):
+        self.append(SNAPSHOT, pack_state(game.dump_state()))
+        self.events_since_snapshot = 0
+
+    def event_done(self, game):
+        self.events_since_snapshot += 1
+        if self.events_since_snapshot >= self.SNAPSHOT_EVERY:
+            self.snapshot(game)
+            self.flush()
+            if self.file.tell() > self.COMPACT_BYTES:
+                self.compact(game)
+        else:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.file.write(b''.join(self.pending))
+        self.pending = []
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def compact(self, game):
+        # Atomically replace the journal with a single snapshot
+        tmp_path = self.path + '.tmp'
+        self.file.close()
+        self.file = open(tmp_path, 'wb')
+        self.snapshot(game)
+        self.flush()
+        os.rename(tmp_path, self.path)
+        log("Compacted journal %s", self.path)
+
+    def finish(self):
+        self.append(END, b'')
+        self.close()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+class JournalSession:
+
+    # Wraps a game's session so every outbound call is journaled
+
+    def __init__(self, session, journal):
+        self.session = session
+        self.journal = journal
+        for method_name in Game.SESSION_CALLS:
+            setattr(self, method_name, self._wrap(method_name))
+
+    def _wrap(self, method_name):
+        def inner(*args, **kwargs):
+            self.journal.outbound(method_name, args, kwargs)
+            return getattr(self.session, method_name)(*args, **kwargs)
+        return inner
+
+    @property
+    def clients(self):
+        return self.session.clients
+
+    def client_ids(self):
+        return self.session.client_ids()
+
+def recover(path, num_players):
+    # Rebuilds the game in the journal at path, or returns None if there is
+    # nothing to resume. The game is attached to a muted session; the caller
+    # swaps in a live one and sends clients a fresh snapshot.
+    if not os.path.exists(path):
+        return None
+    start = time.time()
+    state, tail, finished = None, [], False
+    valid = 0
+    for kind, payload, valid in read_records(path):
+        if kind == SNAPSHOT:
+            state, tail = unpack_state(payload), []
+        elif kind == INBOUND:
+            tail.append(payload)
+        elif kind == END:
+            finished = True
+    if finished or state is None:
+        return None
+    # Drop any torn tail so records appended from here on stay readable
+    if os.path.getsize(path) > valid:
+        with open(path, 'r+b') as f:
+            f.truncate(valid)
+
+    # Imported here: host_communication pulls in the asyncio transport
+    from host_communication import HostReceiver
+    session = NullSession(num_players)
+    game = Game(session)
+    game.load_state(state)
+    receiver = HostReceiver(game)
+    clients = {client.id: client for client in session.clients}
+    for payload in tail:
+        client = clients.get(payload[0])
+        msg = decode_message(payload[1:])
+        if client is None or msg is None:
+            continue
+        if receiver.handle_message(msg, client) == True:
+            return None
+    log("Recovered game from %s in %.1f ms (%d events replayed)",
+        path, (time.time() - start) * 1000, len(tail))
+    return game
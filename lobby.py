@@ -0,0 +1,314 @@
+import sys
+import asyncio
+import secrets
+import itertools
+import metrics
+import protocol
+from remote import RPCSender
+from transport import Connection, batch
+from host import Game
+from host_communication import HostReceiver, optional
+from timers import TimerWheel
+from spectators import SpectatorFeed
+from logger import *
+
+class LobbyClient:
+
+    def __init__(self, conn):
+        self.conn = conn
+        # Seat number within the match, assigned when the match forms
+        self.id = None
+        self.match = None
+        # Clients join the queue with their first message past negotiation,
+        # so a match never forms around a silent one
+        self.ready = False
+        # Messages received before the client was placed in a match
+        self.pending = []
+        # Presented in resume_session to take the seat back after a drop
+        self.token = secrets.token_hex(8)
+        self.grace_timer = None
+
+    def greet(self):
+        self.conn.send_message("client_id", [self.id], {})
+        self.conn.send_message("session_token", [self.token], {})
+
+    def send(self, msg):
+        self.conn.send(msg)
+
+    def close(self):
+        self.conn.close()
+
+class MatchSession(RPCSender):
+
+    def __init__(self, clients, spectators=None):
+        RPCSender.__init__(self, Game.SESSION_CALLS)
+        self.clients = clients
+        self.spectators = spectators
+
+    def client_ids(self):
+        for client in self.clients:
+            yield client.id
+
+    def send(self, msg):
+        for client in self.clients:
+            client.send(msg)
+
+    def send_message(self, type, args, kwargs):
+        protocol.broadcast([client.conn for client in self.clients], type, args, kwargs)
+        if self.spectators is not None:
+            self.spectators.publish(type, args, kwargs)
+
+class Match:
+
+    def __init__(self, id, clients, timers=None):
+        self.id = id
+        for seat, client in enumerate(clients):
+            client.id = seat + 1
+            client.match = self
+            client.greet()
+        self.clients = clients
+        self.spectators = SpectatorFeed(timers) if timers is not None else None
+        self.session = MatchSession(clients, self.spectators)
+        self.game = Game(self.session, timers=timers)
+        if self.spectators is not None:
+            self.spectators.snapshot_source = self.game.snapshot_message
+        for client in clients:
+            client.conn.snapshot_source = self.game.snapshot_message
+        self.receiver = HostReceiver(self.game)
+        self.finished = False
+        self.idle_timer = None
+
+    def handle_message(self, msg, client):
+        return self.receiver.handle_message(msg, client)
+
+class LobbyServer:
+
+    PLAYERS_PER_MATCH = 2
+    # Matches nobody has sent anything to for this long are ended
+    IDLE_TIMEOUT = 300
+    # Seconds a player whose connection drops has to reconnect before their
+    # match ends; the others play on meanwhile. 0 ends it at once.
+    RECONNECT_GRACE = 30
+
+    def __init__(self, ip='127.0.0.1', port=9999, players_per_match=PLAYERS_PER_MATCH,
+                 outbound_limit=None, overflow_policy=None, spectator_port=None, grace=None,
+                 metrics_port=None):
+        self.ip = ip
+        self.port = port
+        self.spectator_port = spectator_port
+        self.metrics_port = metrics_port
+        self.grace = grace if grace is not None else self.RECONNECT_GRACE
+        self.players_per_match = players_per_match
+        self.outbound_limit = outbound_limit
+        self.overflow_policy = overflow_policy
+        self.waiting = []
+        # match id => Match
+        self.matches = {}
+        self.match_ids = itertools.count(1)
+        # connection => LobbyClient
+        self.clients = {}
+        # spectator connection => the Match it watches
+        self.watchers = {}
+        # session token => LobbyClient, for players in running matches
+        self.tokens = {}
+        # Yell expiries and idle deadlines for every match
+        self.timers = TimerWheel()
+
+    def connection(self):
+        return Connection(self.message_received, self.client_left, self.client_joined,
+                          self.outbound_limit, self.overflow_policy)
+
+    async def serve(self):
+        loop = asyncio.get_event_loop()
+        self.timers.attach(loop)
+        server = await loop.create_server(self.connection, self.ip, self.port,
+                                          reuse_address=True)
+        log("Lobby listening on %s:%d", self.ip, self.port)
+        spectator_server = None
+        if self.spectator_port is not None:
+            spectator_server = await loop.create_server(
+                    lambda: Connection(self.spectator_message, self.spectator_left),
+                    self.ip, self.spectator_port, reuse_address=True)
+            log("Spectators on %s:%d", self.ip, self.spectator_port)
+        metrics_server = await self.serve_metrics()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if spectator_server is not None:
+                spectator_server.close()
+            if metrics_server is not None:
+                metrics_server.close()
+
+    async def serve_metrics(self):
+        if self.metrics_port is None:
+            return None
+        metrics.gauge('lobby_waiting', lambda: len(self.waiting))
+        metrics.gauge('lobby_matches', lambda: len(self.matches))
+        metrics.gauge('lobby_spectators', lambda: len(self.watchers))
+        metrics.gauge('timers_pending', lambda: self.timers.count)
+        return await metrics.serve(self.ip, self.metrics_port)
+
+    def client_joined(self, conn):
+        client = LobbyClient(conn)
+        self.clients[conn] = client
+        log("Accepted lobby connection")
+
+    def message_received(self, msg, conn):
+        client = self.clients[conn]
+        if protocol.host_negotiate(msg, conn):
+            return
+        if not client.ready:
+            if msg['type'] == 'resume_session':
+                self.resume(client, msg)
+                return
+            client.ready = True
+            client.pending.append(msg)
+            self.waiting.append(client)
+            self.form_matches()
+            return
+        if client.match is None:
+            client.pending.append(msg)
+        else:
+            self.dispatch(client, msg)
+
+    def form_matches(self):
+        while len(self.waiting) >= self.players_per_match:
+            clients = self.waiting[:self.players_per_match]
+            del self.waiting[:self.players_per_match]
+            match = Match(next(self.match_ids), clients, self.timers)
+            match.game.timer_sink = lambda msg, client: self.dispatch(client, msg)
+            self.matches[match.id] = match
+            for client in clients:
+                self.tokens[client.token] = client
+            self.touch(match)
+            log("Started match %d (%d running)", match.id, len(self.matches))
+            for client in clients:
+                pending, client.pending = client.pending, []
+                for msg in pending:
+                    self.dispatch(client, msg)
+
+    def dispatch(self, client, msg):
+        match = client.match
+        if match is None or match.finished:
+            return
+        try:
+            with batch(c.conn for c in match.clients):
+                rtn = match.handle_message(msg, client)
+        except Exception:
+            # Already logged by the handler; one broken game must not stop the lobby
+            rtn = None
+        if rtn == True:
+            self.finish(match)
+        else:
+            self.touch(match)
+
+    def touch(self, match):
+        if match.idle_timer is not None:
+            match.idle_timer.cancel()
+        match.idle_timer = self.timers.schedule(self.IDLE_TIMEOUT, self.reap, match)
+
+    def reap(self, match):
+        match.idle_timer = None
+        if match.finished:
+            return
+        log_warn("Match %d idle for %d seconds", match.id, self.IDLE_TIMEOUT)
+        with batch(c.conn for c in match.clients):
+            match.session.end_game(match.game.scores, "Game idle -- ")
+        self.finish(match)
+
+    def spectator_message(self, msg, conn):
+        # Spectators pick a match with spectate(match id); nothing else they
+        # send has any effect
+        if protocol.host_negotiate(msg, conn) or msg['type'] != 'spectate' or \
+                conn in self.watchers:
+            return
+        match = self.matches.get(msg['args'][0] if msg['args'] else None)
+        if match is None:
+            log_warn("No match %s to watch", msg['args'])
+            conn.close()
+            return
+        self.watchers[conn] = match
+        match.spectators.add(conn)
+
+    def spectator_left(self, conn):
+        match = self.watchers.pop(conn, None)
+        if match is not None:
+            match.spectators.remove(conn)
+
+    def resume(self, client, msg):
+        # A returning player takes their seat back on this connection and
+        # gets one snapshot of the game as it stands
+        conn = client.conn
+        player = self.tokens.get(msg['args'][0]) if msg['args'] else None
+        if player is None:
+            log_warn("Unknown session token: closing connection")
+            conn.close()
+            return
+        self.clients.pop(player.conn, None)
+        player.conn.close()
+        if player.grace_timer is not None:
+            player.grace_timer.cancel()
+            player.grace_timer = None
+        player.conn = conn
+        self.clients[conn] = player
+        game = player.match.game
+        conn.snapshot_source = game.snapshot_message
+        log("Player %d of match %d reconnected", player.id, player.match.id)
+        with batch([conn]):
+            player.greet()
+            conn.send_message(*game.snapshot_message())
+
+    def client_left(self, conn):
+        client = self.clients.pop(conn, None)
+        if client is None:
+            # Replaced by the connection it reconnected on
+            return
+        if client in self.waiting:
+            self.waiting.remove(client)
+            log("Client left the lobby before a match formed")
+        elif client.match is not None and not client.match.finished:
+            if self.grace > 0:
+                log_warn("Player %d of match %d disconnected; holding their seat for %d seconds",
+                         client.id, client.match.id, self.grace)
+                client.grace_timer = self.timers.schedule(self.grace, self.grace_expired, client)
+                return
+            self.dispatch(client, dict(type='disconnect', args=[], kwargs={}))
+        client.close()
+
+    def grace_expired(self, client):
+        client.grace_timer = None
+        log_warn("Player %d of match %d did not reconnect", client.id, client.match.id)
+        self.dispatch(client, dict(type='disconnect', args=[], kwargs={}))
+
+    def finish(self, match):
+        match.finished = True
+        match.game.cancel_timers()
+        if match.idle_timer is not None:
+            match.idle_timer.cancel()
+            match.idle_timer = None
+        # Watchers see the end of the game, then are let go
+        match.spectators.close()
+        del self.matches[match.id]
+        for client in match.clients:
+            if client.grace_timer is not None:
+                client.grace_timer.cancel()
+                client.grace_timer = None
+            self.tokens.pop(client.token, None)
+            client.close()
+        log("Finished match %d (%d running)", match.id, len(self.matches))
+
+def run_lobby(ip='127.0.0.1', port=9999, players_per_match=LobbyServer.PLAYERS_PER_MATCH,
+              spectator_port=None, metrics_port=None):
+    lobby = LobbyServer(ip, int(port), int(players_per_match),
+                        spectator_port=optional(spectator_port, int),
+                        metrics_port=optional(metrics_port, int))
+    asyncio.run(lobby.serve())
+
+if __name__ == '__main__':
+    init_stdoutlog()
+    if len(sys.argv) > 6:
+        print("Usage: python %s [ip] [port] [# players per match] [spectator port] [metrics port]" % sys.argv[0])
+        print("       ('-' for either port leaves it out)")
+        exit(1)
+    run_lobby(*sys.argv[1:])
@@ -1,19 +1,168 @@
+import json
+import queue
+import atexit
+import random
 import logging
+import logging.handlers
 
-def init_logfile(filename):
-    logging.basicConfig(filename=filename,level=logging.DEBUG)
+from logging import DEBUG, INFO, WARNING, ERROR
 
-def init_stdoutlog():
-    logging.basicConfig(level=logging.DEBUG)
+__all__ = ['DEBUG', 'INFO', 'WARNING', 'ERROR',
+           'log', 'log_warn', 'log_error', 'log_enabled', 'get_log',
+           'set_level', 'set_sampling', 'init_logfile', 'init_stdoutlog',
+           'stop_logging', 'JsonLinesFormatter']
 
-def log(msg, *args, **kwargs):
-    try:
-        logging.debug(msg, *args, **kwargs)
-    except Exception as e:
-        logging.warn("Error logging")
+# All 53T logging goes through the '53t' logger tree, one child per subsystem
+# ('53t.remote', '53t.ui', ...). Records are handed to a queue and written by
+# a background listener thread, so file I/O never happens on the game or UI
+# threads. Every subsystem caches its threshold, so a disabled log call costs
+# one comparison and never formats its arguments.
+
+ROOT_NAME = '53t'
+
+_default_level = WARNING
+_levels = {}
+_sampling = {}
+_subsystems = {}
+_listener = None
+
+class JsonLinesFormatter(logging.Formatter):
+
+    def format(self, record):
+        rtn = dict(
+            time = record.created,
+            level = record.levelname,
+            subsystem = record.name,
+            thread = record.threadName,
+            msg = record.getMessage(),
+        )
+        if record.exc_info:
+            rtn['exc'] = self.formatException(record.exc_info)
+        return json.dumps(rtn, default=str)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    # The message is rendered here, while its arguments still hold the values
+    # they had at the call, but the line formatting and the write happen on
+    # the listener thread
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class SubsystemLog:
+
+    def __init__(self, name):
+        self.name = name
+        self.logger = logging.getLogger(ROOT_NAME + '.' + name if name else ROOT_NAME)
+        self.threshold = WARNING
+        self.sample_rate = 1.0
+        self.refresh()
+
+    def refresh(self):
+        self.threshold = _levels.get(self.name, _default_level)
+        self.sample_rate = _sampling.get(self.name, 1.0)
+        self.logger.setLevel(self.threshold)
+
+    def enabled(self, level=DEBUG):
+        return level >= self.threshold
+
+    def debug(self, msg, *args):
+        if self.threshold <= DEBUG and \
+                (self.sample_rate >= 1 or random.random() < self.sample_rate):
+            self.logger.debug(msg, *args)
+
+    def info(self, msg, *args):
+        if self.threshold <= INFO:
+            self.logger.info(msg, *args)
 
-def log_warn(*args, **kwargs):
+    def warn(self, msg, *args, **kwargs):
+        if self.threshold <= WARNING:
+            self.logger.warning(msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        if self.threshold <= ERROR:
+            self.logger.error(msg, *args, **kwargs)
+
+def get_log(subsystem=None):
+    rtn = _subsystems.get(subsystem)
+    if rtn is None:
+        rtn = _subsystems[subsystem] = SubsystemLog(subsystem)
+    return rtn
+
+def _refresh():
+    for subsystem in _subsystems.values():
+        subsystem.refresh()
+
+def set_level(level, subsystem=None):
+    # With no subsystem, sets the level of every subsystem not set explicitly
+    global _default_level
+    if subsystem is None:
+        _default_level = level
+    else:
+        _levels[subsystem] = level
+    _refresh()
+
+def set_sampling(subsystem, rate):
+    # Keep roughly `rate` of the subsystem's debug records
+    _sampling[subsystem] = rate
+    _refresh()
+
+def log_enabled(level=DEBUG, subsystem=None):
+    return get_log(subsystem).enabled(level)
+
+def _start(handler, level):
+    global _listener
+    stop_logging()
+    root = logging.getLogger(ROOT_NAME)
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    records = queue.Queue(-1)
+    root.addHandler(_QueueHandler(records))
+    root.propagate = False
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+    set_level(level)
+
+def stop_logging():
+    # Flushes everything queued so far; registered to run at exit
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(stop_logging)
+
+def init_logfile(filename, level=DEBUG, json_lines=False):
+    handler = logging.FileHandler(filename)
+    if json_lines:
+        handler.setFormatter(JsonLinesFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(message)s'))
+    _start(handler, level)
+
+def init_stdoutlog(level=DEBUG, json_lines=False):
+    handler = logging.StreamHandler()
+    if json_lines:
+        handler.setFormatter(JsonLinesFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(message)s'))
+    _start(handler, level)
+
+_log = get_log()
+
+def log(msg, *args):
+    _log.debug(msg, *args)
+
+def log_warn(msg, *args, **kwargs):
     try:
-        logging.warn(*args, **kwargs)
+        _log.warn(msg, *args, **kwargs)
     except Exception as e:
-        logging.warn("Error logging: %s", args)
+        _log.warn("Error logging: %s", msg)
+
+def log_error(msg, *args, **kwargs):
+    _log.error(msg, *args, **kwargs)
@@ -0,0 +1,227 @@
+import os
+import weakref
+import asyncio
+from logger import *
+
+LOG = get_log('metrics')
+
+# In-process counters, latency histograms and gauges, read out in the
+# Prometheus text format: scraped over HTTP from serve(), or written to a
+# file by dump(). Recording is a few integer operations on the calling
+# thread; all the formatting happens when somebody reads them.
+
+PREFIX = 't53_'
+
+class Histogram:
+
+    # Log-linear buckets in the manner of HdrHistogram: values below SUB
+    # each get a bucket, and every power of two above that is split into
+    # SUB / 2 equal buckets, so any recorded value is known to within
+    # 1 / (SUB / 2) of itself whatever its size, in a fixed small array
+
+    SUB_BITS = 5
+    SUB = 1 << SUB_BITS
+    HALF = SUB >> 1
+    # Values are clamped to below 2 ** MAX_BITS (about 18 minutes in ns)
+    MAX_BITS = 40
+
+    def __init__(self):
+        self.counts = [0] * self.index(1 << self.MAX_BITS)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @classmethod
+    def index(cls, value):
+        bits = value.bit_length()
+        if bits <= cls.SUB_BITS:
+            return value
+        shift = bits - cls.SUB_BITS
+        return shift * cls.HALF + (value >> shift)
+
+    @classmethod
+    def lowest(cls, index):
+        # The smallest value that lands in bucket index
+        if index < cls.SUB:
+            return index
+        shift = index // cls.HALF - 1
+        return (index - shift * cls.HALF) << shift
+
+    def record(self, value):
+        # index() inlined: this runs on every message handled
+        bits = value.bit_length()
+        if bits > self.SUB_BITS:
+            if bits > self.MAX_BITS:
+                value = (1 << self.MAX_BITS) - 1
+                bits = self.MAX_BITS
+            shift = bits - self.SUB_BITS
+            self.counts[shift * self.HALF + (value >> shift)] += 1
+        else:
+            self.counts[value] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        # Upper edge of the bucket holding the q'th value (never past max)
+        if self.count == 0:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.lowest(index + 1) - 1, self.max)
+        return self.max
+
+class HandlerStats(Histogram):
+
+    # Latencies in ns of one message type's handler; count is how many ran
+
+    def __init__(self):
+        Histogram.__init__(self)
+        self.errors = 0
+
+# (handler name, message type) => HandlerStats
+handlers = {}
+# (name, labels) => function returning the gauge's current value
+gauges = {}
+# Live transport.Connections; bytes and outbound queue counts of those
+# closed are kept in the totals
+connections = weakref.WeakSet()
+closed_totals = dict(received=0, sent=0, count=0, dropped=0, snapshots=0, overflows=0)
+
+# OutboundQueue.stats() counts, exported per connection and in total
+QUEUE_COUNTS = (
+    ('dropped', 'Outbound frames dropped by an overflow policy'),
+    ('snapshots', 'Snapshots sent to resync connections whose queue overflowed'),
+    ('overflows', 'Outbound frames that found their queue full'),
+)
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+def handler_stats(handler, type):
+    key = (handler, type)
+    stats = handlers.get(key)
+    if stats is None:
+        stats = handlers[key] = HandlerStats()
+    return stats
+
+def gauge(name, fn, **labels):
+    # fn() is called for the gauge's value each time metrics are read
+    gauges[(name, tuple(sorted(labels.items())))] = fn
+
+def remove_gauge(name, **labels):
+    gauges.pop((name, tuple(sorted(labels.items()))), None)
+
+def connection_opened(conn):
+    connections.add(conn)
+
+def connection_closed(conn):
+    if conn in connections:
+        connections.discard(conn)
+        closed_totals['received'] += conn.bytes_received
+        closed_totals['sent'] += conn.bytes_sent
+        closed_totals['count'] += 1
+        stats = conn.outbound.stats()
+        for name, _ in QUEUE_COUNTS:
+            closed_totals[name] += stats[name]
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for key, value in labels) + '}'
+
+def exposition():
+    lines = []
+    def metric(name, type, help, samples):
+        lines.append('# HELP %s%s %s' % (PREFIX, name, help))
+        lines.append('# TYPE %s%s %s' % (PREFIX, name, type))
+        for suffix, labels, value in samples:
+            lines.append('%s%s%s%s %s' % (PREFIX, name, suffix, format_labels(labels), value))
+
+    stats = sorted(handlers.items())
+    metric('messages_handled_total', 'counter', 'Messages dispatched by MsgHandler',
+           [('', (('handler', handler), ('type', type)), s.count) for (handler, type), s in stats])
+    metric('message_errors_total', 'counter', 'Handlers that raised',
+           [('', (('handler', handler), ('type', type)), s.errors) for (handler, type), s in stats])
+    samples = []
+    for (handler, type), s in stats:
+        labels = (('handler', handler), ('type', type))
+        for q in QUANTILES:
+            samples.append(('', labels + (('quantile', q),), s.quantile(q) / 1e9))
+        samples.append(('_sum', labels, s.total / 1e9))
+        samples.append(('_count', labels, s.count))
+    metric('message_seconds', 'summary', 'Time spent in each message handler', samples)
+
+    values = []
+    for (name, labels), fn in sorted(gauges.items()):
+        try:
+            values.append((name, labels, fn()))
+        except Exception:
+            LOG.warn("Gauge %s failed", name)
+    for name in sorted(set(name for name, _, _ in values)):
+        metric(name, 'gauge', name.replace('_', ' ').capitalize(),
+               [('', labels, value) for gauge_name, labels, value in values if gauge_name == name])
+
+    live = [(conn, (('local', conn.local), ('peer', conn.peer)), conn.outbound.stats())
+            for conn in connections]
+    metric('connections', 'gauge', 'Open connections', [('', (), len(live))])
+    metric('outbound_queued_bytes', 'gauge', 'Bytes waiting for slow peers to catch up',
+           [('', (), sum(stats['bytes'] for _, _, stats in live))])
+    metric('connections_closed_total', 'counter', 'Connections closed', [('', (), closed_totals['count'])])
+    for direction in ('received', 'sent'):
+        attr = 'bytes_' + direction
+        metric('%s_bytes_total' % direction, 'counter', 'Bytes %s on every connection' % direction,
+               [('', (), closed_totals[direction] + sum(getattr(conn, attr) for conn, _, _ in live))])
+        metric('connection_%s_bytes' % direction, 'gauge', 'Bytes %s on each open connection' % direction,
+               [('', labels, getattr(conn, attr)) for conn, labels, _ in live])
+
+    metric('connection_outbound_depth', 'gauge', 'Frames queued for each open connection',
+           [('', labels, stats['depth']) for _, labels, stats in live])
+    metric('connection_outbound_bytes', 'gauge', 'Bytes queued for each open connection',
+           [('', labels, stats['bytes']) for _, labels, stats in live])
+    metric('connection_outbound_max_bytes', 'gauge', 'Most bytes ever queued for each open connection',
+           [('', labels, stats['max_bytes']) for _, labels, stats in live])
+    for name, help in QUEUE_COUNTS:
+        metric('outbound_%s_total' % name, 'counter', help + ', on every connection',
+               [('', (), closed_totals[name] + sum(stats[name] for _, _, stats in live))])
+        metric('connection_outbound_%s' % name, 'gauge', help + ', on each open connection',
+               [('', labels, stats[name]) for _, labels, stats in live])
+    return '\n'.join(lines) + '\n'
+
+def dump(path):
+    # Written whole and renamed over the old dump, so readers never see half
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(exposition())
+    os.replace(tmp, path)
+
+def dump_every(loop, path, interval):
+    # Dumps to path every interval seconds for as long as loop runs
+    try:
+        dump(path)
+    except OSError as e:
+        LOG.warn("Could not write metrics to %s: %s", path, e)
+    loop.call_later(interval, dump_every, loop, path, interval)
+
+async def scrape(reader, writer):
+    try:
+        await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+        body = exposition().encode('utf-8')
+        writer.write(b'HTTP/1.0 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4\r\n'
+                     b'Content-Length: %d\r\n\r\n' % len(body) + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+        pass
+    finally:
+        writer.close()
+
+async def serve(ip, port):
+    # Serves the current metrics to any HTTP GET on ip:port
+    server = await asyncio.start_server(scrape, ip, port, reuse_address=True)
+    log("Metrics on http://%s:%d/metrics", ip, port)
+    return server
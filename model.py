@@ -2,20 +2,76 @@ import random
 from logger import *
 import itertools
 
-class Card:
+class Card(object):
 
     COLORS = ('r','b','g')
     SHAPES = ('s','d','o')
     SHADINGS = ('e','f','s')
     NUMBERS = (1,2,3)
 
-    def __init__(self, color, shape, shading, number):
-        self.color, self.shape, self.shading, self.number = \
+    N_CARDS = 81
+
+    __slots__ = ('id', 'color', 'shape', 'shading', 'number', 'properties')
+
+    # Every card is interned: Card(...) and Card.from_id(...) always return
+    # one of the 81 instances in ALL, so equality is an integer compare
+    ALL = []
+    _BY_PROPS = {}
+
+    # THIRD[a][b] is the id of the card completing a set with cards a and b
+    THIRD = []
+
+    def __new__(cls, color, shape, shading, number):
+        try:
+            return cls._BY_PROPS[(color, shape, shading, number)]
+        except KeyError:
+            raise ValueError("Not a card: %s" % ((color, shape, shading, number),))
+
+    @classmethod
+    def _make(cls, id, color, shape, shading, number):
+        card = object.__new__(cls)
+        card.id = id
+        card.color, card.shape, card.shading, card.number = \
                 color, shape, shading, number
+        card.properties = color, shape, shading, number
+        return card
 
-    @property
-    def properties(self):
-        return str(self.color), str(self.shape), str(self.shading), self.number
+    @staticmethod
+    def encode(color_i, shape_i, shading_i, number_i):
+        # Base-3 digits, most significant first
+        return ((color_i * 3 + shape_i) * 3 + shading_i) * 3 + number_i
+
+    @staticmethod
+    def decode(id):
+        return id // 27, id // 9 % 3, id // 3 % 3, id % 3
+
+    @classmethod
+    def from_id(cls, id):
+        return cls.ALL[id]
+
+    @classmethod
+    def lookup(cls, properties):
+        # The card with these properties, or None if they are not a card's
+        # (e.g. as sent by a buggy or hostile client)
+        try:
+            return cls._BY_PROPS.get(tuple(properties))
+        except TypeError:
+            return None
+
+    @classmethod
+    def _init_tables(cls):
+        for id in range(cls.N_CARDS):
+            c, s, sh, n = cls.decode(id)
+            card = cls._make(id, cls.COLORS[c], cls.SHAPES[s],
+                             cls.SHADINGS[sh], cls.NUMBERS[n])
+            cls.ALL.append(card)
+            cls._BY_PROPS[card.properties] = card
+
+        # Each digit of the third card is the one that makes the digit sum 0 mod 3
+        digits = [cls.decode(id) for id in range(cls.N_CARDS)]
+        for a in digits:
+            cls.THIRD.append([cls.encode(*[(-x - y) % 3 for x, y in zip(a, b)])
+                              for b in digits])
 
     @staticmethod
     def third_prop(props, prop_a, prop_b):
@@ -27,12 +83,7 @@ class Card:
                     return c
 
     def third(self, second):
-        color = self.third_prop(self.COLORS, self.color, second.color)
-        shape = self.third_prop(self.SHAPES, self.shape, second.shape)
-        shade = self.third_prop(self.SHADINGS, self.shading, second.shading)
-        number = self.third_prop(self.NUMBERS, self.number, second.number)
-
-        return Card(color, shape, shade, number)
+        return self.ALL[self.THIRD[self.id][second.id]]
 
     def dict(self):
         return dict(
@@ -43,20 +94,33 @@ class Card:
         )
 
     def __eq__(self, other):
-        log("Comparing...")
-        return self.properties == other.properties
+        return isinstance(other, Card) and self.id == other.id
 
     def __ne__(self, other):
-        log("Comparing not...")
-        return self.properties != other.properties
+        return not isinstance(other, Card) or self.id != other.id
+
+    def __hash__(self):
+        return self.id
+
+    # Flyweights: copies and unpickled cards are the interned instance
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (Card.from_id, (self.id,))
 
     def __str__(self):
         return '< Card: ' + str(self.properties) + " >"
-            
-    
+
+
     def __repr__(self):
         return str(self)
-    
+
+Card._init_tables()
+
 class Deck:
 
     ALL_PARAMS = list(itertools.product(
@@ -67,7 +131,7 @@ class Deck:
     ))
 
     def __init__(self):
-        self.all_cards = [Card(*p) for p in self.ALL_PARAMS]
+        self.all_cards = list(Card.ALL)
 
         self.deck = self.all_cards[:]
         log("Deck is %s", self.deck)
@@ -81,4 +145,3 @@ class Deck:
     def draw(self):
         #log("Drawing %dth card", len(self.deck))
         return self.deck.pop()
-
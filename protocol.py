@@ -0,0 +1,278 @@
+import json
+import struct
+from model import Card
+from geometry import STANDARD
+from logger import *
+
+# Wire codecs. Every connection starts on JSON in both directions. A client
+# that knows other protocols says so in its first message, and each direction
+# switches at a fixed point in its own stream:
+#
+#   client -> hello([[name, version], ...])
+#   host   -> protocol_selected(name, version)   host now sends the new codec
+#   client -> protocol_ack()                     client now sends it too
+#
+# Old hosts ignore 'hello' and old clients never send it, so either side can
+# be older and the connection simply stays on JSON.
+
+class JsonCodec:
+
+    NAME = 'json'
+    VERSION = 1
+
+    FRAME_END = b'~'
+
+    def encode(self, type, args, kwargs):
+        # '~' can only appear inside JSON strings, where the escape is equivalent
+        msg = json.dumps(dict(type=type, args=args, kwargs=kwargs)).replace('~', '\\u007e')
+        return (msg + '~').encode('utf-8')
+
+    def next_frame(self, buffer, start, end=None):
+        # Returns (message, next start), or (None, start) if no full frame is
+        # buffered in buffer[start:end]. Frames are decoded where they lie.
+        if end is None:
+            end = len(buffer)
+        while True:
+            stop = buffer.find(self.FRAME_END, start, end)
+            if stop < 0:
+                return None, start
+            frame_start, start = start, stop + 1
+            if stop == frame_start:
+                continue
+            frame = buffer[frame_start:stop]
+            try:
+                return json.loads(frame.decode('utf-8')), start
+            except ValueError:
+                log_warn("Could not load JSON from %s", frame)
+
+class FrameTooLarge(ValueError):
+    # The message cannot be put in a binary frame: its length field is 16 bits
+    pass
+
+class BinaryCodec:
+
+    # Frame: !H length of the rest, B opcode, payload.
+    # Opcodes are indices into OPCODES; new message types must be appended.
+    # An opcode with JSON_FLAG set carries [args, kwargs] as JSON instead of
+    # its packed schema, for messages that don't fit it (kwargs, big values).
+
+    NAME = 'binary'
+    VERSION = 1
+
+    OPCODES = (
+        'client_id',
+        # Game.SESSION_CALLS
+        'remove', 'select', 'deselect', 'place', 'set_yelled', 'score_update',
+        'set_stolen', 'too_late', 'end_game', 'resume', 'more_requested',
+        # RemoteHost.CALLS
+        'select_card', 'deselect_card', 'check_set', 'yell_set', 'request_more',
+        'start', 'disconnect',
+        # Negotiation
+        'hello', 'protocol_selected', 'protocol_ack',
+        'board_snapshot',
+    )
+    OPCODE = {name: i for i, name in enumerate(OPCODES)}
+
+    JSON_FLAG = 0x80
+    # Message types missing from OPCODES: payload is the whole JSON message
+    GENERIC = 0x7f
+
+    HEADER = struct.Struct('!HB')
+    # The length field counts the opcode byte too
+    MAX_PAYLOAD = 0xffff - 1
+
+    # (card, x, y) packs to a card id byte and an x<<4|y byte
+    CARD_XY = ('remove', 'select', 'deselect', 'place', 'select_card', 'deselect_card')
+
+    SCHEMAS = {
+        'client_id': struct.Struct('!B'),
+        'set_yelled': struct.Struct('!B'),
+        'set_stolen': struct.Struct('!B'),
+        'too_late': struct.Struct('!Bh'),
+        'more_requested': struct.Struct('!BBB'),
+        'resume': struct.Struct(''),
+        'check_set': struct.Struct(''),
+        'yell_set': struct.Struct(''),
+        'request_more': struct.Struct(''),
+        'start': struct.Struct(''),
+        'disconnect': struct.Struct(''),
+    }
+    CARD_XY_STRUCT = struct.Struct('!BB')
+
+    def pack_payload(self, type, args):
+        if type == 'board_snapshot':
+            cards, = args
+            return b''.join(self.pack_card_xy(*card) for card in cards)
+        if type in self.CARD_XY:
+            return self.pack_card_xy(*args)
+        if type in self.SCHEMAS:
+            return self.SCHEMAS[type].pack(*args)
+        return None
+
+    def pack_card_xy(self, card, x, y):
+        if not (0 <= x < 16 and 0 <= y < 16):
+            raise ValueError("Position out of range")
+        return self.CARD_XY_STRUCT.pack(Card(*card).id, x << 4 | y)
+
+    def unpack_card_xy(self, payload, offset=0):
+        card_id, xy = self.CARD_XY_STRUCT.unpack_from(payload, offset)
+        return [list(Card.from_id(card_id).properties), xy >> 4, xy & 0xf]
+
+    def encode(self, type, args, kwargs):
+        opcode = self.OPCODE.get(type)
+        if opcode is None:
+            payload = json.dumps(dict(type=type, args=args, kwargs=kwargs)).encode('utf-8')
+            opcode = self.GENERIC
+        else:
+            payload = None
+            if not kwargs:
+                try:
+                    payload = self.pack_payload(type, args)
+                except (struct.error, ValueError, TypeError):
+                    payload = None
+            if payload is None:
+                payload = json.dumps([args, kwargs]).encode('utf-8')
+                opcode |= self.JSON_FLAG
+        if len(payload) > self.MAX_PAYLOAD:
+            raise FrameTooLarge("%s message of %d bytes does not fit a binary frame"
+                                % (type, len(payload)))
+        return self.HEADER.pack(len(payload) + 1, opcode) + payload
+
+    def decode(self, opcode, buffer, start=0, stop=None):
+        # Decodes the payload at buffer[start:stop]; packed payloads are
+        # unpacked where they lie, without slicing them out
+        if stop is None:
+            stop = len(buffer)
+        if opcode == self.GENERIC:
+            return json.loads(buffer[start:stop].decode('utf-8'))
+        type = self.OPCODES[opcode & ~self.JSON_FLAG]
+        if opcode & self.JSON_FLAG:
+            args, kwargs = json.loads(buffer[start:stop].decode('utf-8'))
+            return dict(type=type, args=args, kwargs=kwargs)
+        length = stop - start
+        if type == 'board_snapshot':
+            size = self.CARD_XY_STRUCT.size
+            if length % size:
+                raise ValueError("Truncated board snapshot")
+            args = [[self.unpack_card_xy(buffer, i) for i in range(start, stop, size)]]
+        elif type in self.CARD_XY:
+            if length != self.CARD_XY_STRUCT.size:
+                raise ValueError("Bad card frame length")
+            args = self.unpack_card_xy(buffer, start)
+        else:
+            schema = self.SCHEMAS[type]
+            if length != schema.size:
+                raise struct.error("unpack requires a buffer of %d bytes" % schema.size)
+            args = list(schema.unpack_from(buffer, start))
+        return dict(type=type, args=args, kwargs={})
+
+    def next_frame(self, buffer, start, end=None):
+        if end is None:
+            end = len(buffer)
+        while end - start >= self.HEADER.size:
+            length, opcode = self.HEADER.unpack_from(buffer, start)
+            stop = start + 2 + length
+            if end < stop:
+                break
+            payload_start, start = start + self.HEADER.size, stop
+            try:
+                return self.decode(opcode, buffer, payload_start, stop), start
+            except (ValueError, IndexError, struct.error) as e:
+                log_warn("Could not decode binary frame %d: %s", opcode, e)
+        return None, start
+
+JSON = JsonCodec()
+BINARY = BinaryCodec()
+
+CODECS = {
+    (JSON.NAME, JSON.VERSION): JSON,
+    (BINARY.NAME, BINARY.VERSION): BINARY,
+}
+
+# In order of preference
+SUPPORTED = [[BINARY.NAME, BINARY.VERSION], [JSON.NAME, JSON.VERSION]]
+
+def expand_snapshot(cards, selected=(), scores=None, yeller=None):
+    # board_snapshot as the individual messages a pre-negotiation client knows.
+    # The client's board may be stale, so empty slots are cleared explicitly
+    # and a finished yell is ended with a resume.
+    cards_at = {(x, y): card for card, x, y in cards}
+    rtn = [('remove', [None, x, y], {}) for x, y in STANDARD.positions if (x, y) not in cards_at]
+    rtn.extend(('place', [card, x, y], {}) for card, x, y in cards)
+    if yeller is not None:
+        rtn.append(('set_yelled', [yeller], {}))
+    else:
+        rtn.append(('resume', [], {}))
+    rtn.extend(('select', [cards_at[(x, y)], x, y], {}) for x, y in selected)
+    if scores is not None:
+        rtn.append(('score_update', [scores], {}))
+    return rtn
+
+# Messages a lagging peer must still get after its queue is collapsed into
+# a snapshot, which cannot carry them
+MUST_DELIVER = ('end_game',)
+
+# Messages old clients don't understand, and how to rewrite them
+LEGACY_EXPANSIONS = {
+    'board_snapshot': expand_snapshot,
+}
+
+def frame_for(conn, type, args, kwargs):
+    if not conn.negotiated and type in LEGACY_EXPANSIONS:
+        return b''.join(JSON.encode(*msg) for msg in LEGACY_EXPANSIONS[type](*args, **kwargs))
+    return conn.out_codec.encode(type, args, kwargs)
+
+def broadcast(conns, type, args, kwargs):
+    # Encode once per codec in use, not once per connection
+    frames = {}
+    for conn in conns:
+        key = conn.out_codec if conn.negotiated else None
+        frame = frames.get(key)
+        if frame is None:
+            try:
+                frame = frames[key] = frame_for(conn, type, args, kwargs)
+            except FrameTooLarge as e:
+                frame = frames[key] = False
+                log_warn("Dropping connections that cannot be sent a message: %s", e)
+        if frame is False:
+            # The peer would be out of step from here on
+            conn.abort()
+            continue
+        conn.send(frame, type in MUST_DELIVER)
+
+def hello(conn):
+    conn.send_message('hello', [SUPPORTED], {})
+
+def host_negotiate(msg, conn):
+    # Handles a client's hello/protocol_ack; True if msg was consumed
+    if msg['type'] == 'hello':
+        conn.negotiated = True
+        for name, version in msg['args'][0]:
+            codec = CODECS.get((name, version))
+            if codec is not None:
+                conn.send_message('protocol_selected', [name, version], {})
+                conn.out_codec = codec
+                log("Sending %s protocol", codec.NAME)
+                return True
+        log_warn("Client offered no supported protocol: %s", msg['args'])
+        return True
+    if msg['type'] == 'protocol_ack':
+        # Everything after this frame in the client's stream uses the new codec
+        conn.codec = conn.out_codec
+        log("Receiving %s protocol", conn.codec.NAME)
+        return True
+    return False
+
+def client_negotiate(msg, conn):
+    # Handles the host's protocol_selected; True if msg was consumed
+    if msg['type'] != 'protocol_selected':
+        return False
+    codec = CODECS.get(tuple(msg['args']))
+    if codec is None:
+        log_warn("Host selected unknown protocol %s", msg['args'])
+        return True
+    conn.codec = codec
+    conn.send_message('protocol_ack', [], {})
+    conn.out_codec = codec
+    log("Switched connection to %s protocol", codec.NAME)
+    return True
@@ -1,24 +1,39 @@
 import json
 import select
+import protocol
+import metrics
+from transport import ReceiveBuffer
 from functools import partial
+from time import perf_counter_ns
 from logger import *
 import traceback 
+
+LOG = get_log('remote')
+
 class RPCSender:
 
     def __init__(self, methods):
         for method_name in methods:
-            log("Registering method %s", method_name)
+            LOG.debug("Registering method %s", method_name)
             setattr(self, method_name, partial(self._send, method_name))
 
     def _send(self, type, *args, **kwargs):
+        self.send_message(type, args, kwargs)
+
+    def send_message(self, type, args, kwargs):
+        # Senders that pick a wire encoding per connection override this
         rtn = dict(type = type, args=args, kwargs=kwargs)
         rtn = json.dumps(rtn) + '~'
         self.send(rtn)
-        log('Sent message %s' % rtn)
+        LOG.debug('Sent message %s', rtn)
 
 
-def msg_generator(sock_map):
-    sockets = sock_map.keys()
+def msg_generator(sock_map, codec=protocol.JSON):
+    # Yields (message, client) for each frame read from the sockets in
+    # sock_map (socket => client) until one of them closes. Each socket reads
+    # into its own ReceiveBuffer, so frames split across reads are kept.
+    sockets = list(sock_map)
+    buffers = {sock: ReceiveBuffer() for sock in sockets}
 
     while True:
         log("Selecting on %d sockets", len(sockets))
@@ -29,42 +44,48 @@ def msg_generator(sock_map):
                 return
         except:
             continue
-        sock = socks[0]
-
-        client =  sock_map[sock]
-        log("client %s responded", client)
 
-        msg = ''
-        while not msg.endswith('~'):
-            msg = ''
-            new_msg = sock.recv(2048)
-            if len(new_msg) == 0:
+        for sock in socks:
+            client = sock_map[sock]
+            log("client %s responded", client)
+            buffer = buffers[sock]
+            nbytes = sock.recv_into(buffer.get_buffer())
+            if nbytes == 0:
                 log_warn("Did not receive anything! Error likely. Exiting")
                 return
-            msg += new_msg
-            if not msg.endswith('~'):
-                log_warn("Did not receive full message: %s", msg)
-                continue
-
-            messages = msg.split('~')
-            for message in messages:
-                if len(message) == 0:
-                    continue
-                try:
-                    yield json.loads(message), client
-                except Exception as e:
-                    log_warn("Could not load JSON from %s", message)
+            buffer.filled(nbytes)
+            while True:
+                msg = buffer.next_message(codec)
+                if msg is None:
+                    break
+                yield msg, client
+            if len(buffer) > buffer.MAX_FRAME:
+                log_warn("No end to a frame from %s in %d bytes. Exiting", client, len(buffer))
+                return
 
 
 class MsgHandler(object):
 
-    def __init__(self):
+    # name labels this handler's counts and latencies in metrics
+    def __init__(self, name=''):
+        self.name = name
         self.handlers = {}
         self.args = []
+        # message type => metrics.HandlerStats
+        self.stats = {}
 
     def bind(self, *args):
         self.args = list(args)
 
+    def bound(self, *args):
+        # A handler sharing these registrations but with its own bound args,
+        # for classes with more than one live instance
+        rtn = MsgHandler(self.name)
+        rtn.handlers = self.handlers
+        rtn.stats = self.stats
+        rtn.args = list(args)
+        return rtn
+
     def register(self, label):
         def inner(fn):
             self.handlers[label] = fn
@@ -74,13 +95,21 @@ class MsgHandler(object):
     def handle(self, type, args, kwargs):
         args = self.args[:] + list(args)
         if type in self.handlers:
+            stats = self.stats.get(type)
+            if stats is None:
+                stats = self.stats[type] = metrics.handler_stats(self.name, type)
+            start = perf_counter_ns()
             try:
-                log("Handling message %s" %[type, args, kwargs])
+                if LOG.enabled(DEBUG):
+                    LOG.debug("Handling message %s", [type, args, kwargs])
                 return self.handlers[type](*args, **kwargs)
             except Exception as e:
+                stats.errors += 1
                 log_warn("Exception %s encondered handling event %s", e, [type, [self.args] + args, kwargs])
                 log_warn(traceback.format_exc())
                 raise
+            finally:
+                stats.record(perf_counter_ns() - start)
         else:
             log_warn("Received unknown message type: %s", type)
 
@@ -0,0 +1,367 @@
+import os
+import sys
+import time
+import mmap
+import struct
+import bisect
+import protocol
+from threading import Thread, Event
+from host import Game
+from board_state import BoardState
+from logger import *
+
+# Archive of a finished game, for review and scrubbing:
+#
+#   MAGIC, VERSION
+#   records: !B kind, !d seconds since start, !I length, binary-protocol frame
+#       EVENT records are the session calls clients received, in order;
+#       a KEYFRAME record (a board_snapshot of the state before the next
+#       event) is written every KEYFRAME_EVERY events
+#   index:   one !IQd (event number, keyframe offset, time) per keyframe
+#   footer:  !QII (index offset, keyframes, events), MAGIC
+#
+# Readers mmap the file and bisect the index, so seeking costs
+# O(log keyframes) plus at most KEYFRAME_EVERY events of replay.
+#
+# The writer flushes at each keyframe. An archive cut short by a crash has
+# no index or footer: readers rebuild the index by scanning its records up
+# to the last complete one, and a host resuming the game from its journal
+# carries on writing from there.
+
+MAGIC = b'53TR'
+VERSION = 1
+
+EVENT = 1
+KEYFRAME = 2
+
+HEADER = struct.Struct('!4sB')
+RECORD = struct.Struct('!BdI')
+INDEX_ENTRY = struct.Struct('!IQd')
+FOOTER = struct.Struct('!QII4s')
+
+CODEC = protocol.BINARY
+
+def unused_path(path):
+    # path, or the first of path.1, path.2, ... that does not exist yet
+    n = 0
+    candidate = path
+    while os.path.exists(candidate):
+        n += 1
+        candidate = '%s.%d' % (path, n)
+    return candidate
+
+class ArchiveWriter:
+
+    KEYFRAME_EVERY = 32
+
+    def __init__(self, path, resume=False):
+        # With resume, an archive already at path is continued rather than
+        # overwritten; ValueError if it is not one
+        self.start = time.time()
+        self.state = BoardState()
+        self.n_events = 0
+        self.index = []
+        if resume and os.path.exists(path):
+            self.file = self.reopen(path)
+        else:
+            self.file = open(path, 'wb')
+            self.file.write(HEADER.pack(MAGIC, VERSION))
+            self.file.flush()
+
+    def reopen(self, path):
+        reader = ArchiveReader(path)
+        try:
+            self.n_events = reader.n_events
+            self.index = list(zip(reader.key_events, reader.key_offsets, reader.key_times))
+            self.state = reader.state_at(reader.n_events)
+            # Times carry on from the last event, skipping the downtime
+            self.start -= reader.duration
+            end = reader.records_end
+            if self.index and self.index[-1][0] == self.n_events:
+                # Its event never made it; the next event writes it again
+                end = self.index.pop()[1]
+        finally:
+            reader.close()
+        log("Continuing archive %s after event %d", path, self.n_events)
+        f = open(path, 'r+b')
+        # Drops the old index and footer, or a torn last record
+        f.truncate(end)
+        f.seek(end)
+        return f
+
+    def write_record(self, kind, t, frame):
+        offset = self.file.tell()
+        self.file.write(RECORD.pack(kind, t, len(frame)))
+        self.file.write(frame)
+        return offset
+
+    def event(self, type, args, kwargs, t=None):
+        if t is None:
+            t = time.time() - self.start
+        try:
+            frame = CODEC.encode(type, args, kwargs)
+        except protocol.FrameTooLarge as e:
+            log_warn("Not archiving message: %s", e)
+            return
+        if self.n_events % self.KEYFRAME_EVERY == 0:
+            # What is before the keyframe survives a crash from here on
+            self.file.flush()
+            offset = self.write_record(KEYFRAME, t, CODEC.encode(*self.state.snapshot_message()))
+            self.index.append((self.n_events, offset, t))
+        self.write_record(EVENT, t, frame)
+        self.state.apply(type, args, kwargs)
+        self.n_events += 1
+
+    def close(self):
+        index_offset = self.file.tell()
+        for entry in self.index:
+            self.file.write(INDEX_ENTRY.pack(*entry))
+        self.file.write(FOOTER.pack(index_offset, len(self.index), self.n_events, MAGIC))
+        self.file.close()
+
+class ArchiveSession:
+
+    # Wraps a game's session so every outbound call is archived
+
+    def __init__(self, session, writer):
+        self.session = session
+        self.writer = writer
+        for method_name in Game.SESSION_CALLS:
+            setattr(self, method_name, self._wrap(method_name))
+
+    def _wrap(self, method_name):
+        def inner(*args, **kwargs):
+            self.writer.event(method_name, args, kwargs)
+            return getattr(self.session, method_name)(*args, **kwargs)
+        return inner
+
+    @property
+    def clients(self):
+        return self.session.clients
+
+    def client_ids(self):
+        return self.session.client_ids()
+
+class ArchiveReader:
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < HEADER.size or HEADER.unpack_from(self.data, 0) != (MAGIC, VERSION):
+            raise ValueError("%s is not a 53T archive" % path)
+        magic = None
+        if len(self.data) >= HEADER.size + FOOTER.size:
+            index_offset, n_keyframes, n_events, magic = \
+                    FOOTER.unpack_from(self.data, len(self.data) - FOOTER.size)
+        if magic == MAGIC:
+            self.records_end = index_offset
+            self.n_events = n_events
+            entries = [INDEX_ENTRY.unpack_from(self.data, index_offset + i * INDEX_ENTRY.size)
+                       for i in range(n_keyframes)]
+        else:
+            log_warn("%s has no index (unfinished archive?): rebuilding it", path)
+            entries = self.scan()
+        self.key_events = [e[0] for e in entries]
+        self.key_offsets = [e[1] for e in entries]
+        self.key_times = [e[2] for e in entries]
+
+    def scan(self):
+        # Index entries for the records up to the last complete one
+        entries = []
+        offset = HEADER.size
+        n_events = 0
+        while offset + RECORD.size <= len(self.data):
+            kind, t, length = RECORD.unpack_from(self.data, offset)
+            end = offset + RECORD.size + length
+            if kind not in (EVENT, KEYFRAME) or end > len(self.data):
+                break
+            if kind == KEYFRAME:
+                entries.append((n_events, offset, t))
+            else:
+                n_events += 1
+            offset = end
+        self.records_end = offset
+        self.n_events = n_events
+        return entries
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def read_record(self, offset):
+        kind, t, length = RECORD.unpack_from(self.data, offset)
+        start = offset + RECORD.size
+        msg, _ = CODEC.next_frame(self.data[start:start + length], 0)
+        return kind, t, msg, start + length
+
+    @property
+    def duration(self):
+        if self.n_events == 0:
+            return 0
+        for _, t, _ in self.events(self.n_events - 1):
+            return t
+
+    def event_at_time(self, t):
+        # Number of the first event at or after t seconds
+        i = max(bisect.bisect_right(self.key_times, t) - 1, 0)
+        if not self.key_offsets:
+            return 0
+        for event_no, event_t, _ in self.events(self.key_events[i]):
+            if event_t >= t:
+                return event_no
+        return self.n_events
+
+    def keyframe_before(self, event_no):
+        # (keyframe message, its event number, offset of the next record)
+        i = max(bisect.bisect_right(self.key_events, event_no) - 1, 0)
+        _, _, msg, next_offset = self.read_record(self.key_offsets[i])
+        return msg, self.key_events[i], next_offset
+
+    def events(self, start=0, stop=None):
+        # Yields (event number, time, message) from event `start`
+        if stop is None:
+            stop = self.n_events
+        if start >= stop or not self.key_offsets:
+            return
+        _, event_no, offset = self.keyframe_before(start)
+        while offset < self.records_end and event_no < stop:
+            kind, t, msg, offset = self.read_record(offset)
+            if kind != EVENT:
+                continue
+            if event_no >= start:
+                yield event_no, t, msg
+            event_no += 1
+
+    def state_at(self, event_no):
+        # Board state just before event_no is applied
+        state = BoardState()
+        if not self.key_offsets:
+            return state
+        msg, key_event, _ = self.keyframe_before(event_no)
+        state.apply(msg['type'], msg['args'], msg['kwargs'])
+        for _, _, msg in self.events(key_event, event_no):
+            state.apply(msg['type'], msg['args'], msg['kwargs'])
+        return state
+
+class ReplayDriver:
+
+    # Feeds an archive to a message sink, normally the ControlQueue of a
+    # ui.LocalController, so the curses Board plays the game back
+
+    def __init__(self, reader, sink, speed=1.0):
+        self.reader = reader
+        self.sink = sink
+        self.speed = speed
+        self.position = 0
+        self.running = Event()
+        self.running.set()
+        self.stopped = False
+        self.jump_to = None
+
+    def emit(self, msg):
+        self.sink(dict(type=msg['type'], args=msg['args'], kwargs=msg['kwargs']))
+
+    def seek(self, event_no):
+        event_no = max(0, min(event_no, self.reader.n_events))
+        type, args, kwargs = self.reader.state_at(event_no).snapshot_message()
+        self.emit(dict(type=type, args=args, kwargs=kwargs))
+        self.position = event_no
+
+    def seek_time(self, t):
+        self.seek(self.reader.event_at_time(t))
+
+    def toggle_pause(self):
+        if self.running.is_set():
+            self.running.clear()
+        else:
+            self.running.set()
+
+    def skip(self, n_events):
+        self.jump_to = self.position + n_events
+        self.running.set()
+
+    def stop(self):
+        self.stopped = True
+        self.running.set()
+
+    def play(self):
+        last_t = None
+        while not self.stopped and self.position < self.reader.n_events:
+            for event_no, t, msg in self.reader.events(self.position):
+                self.running.wait()
+                if self.stopped:
+                    return
+                if self.jump_to is not None:
+                    break
+                if last_t is not None and self.speed > 0:
+                    time.sleep(max(0, t - last_t) / self.speed)
+                last_t = t
+                self.emit(msg)
+                self.position = event_no + 1
+            if self.jump_to is not None:
+                self.seek(self.jump_to)
+                self.jump_to = None
+                last_t = None
+
+class ReplayHost:
+
+    # Stands in for LocalHost/RemoteHost: SPACE pauses, ENTER skips ahead,
+    # BACKSPACE quits
+
+    SKIP = ArchiveWriter.KEYFRAME_EVERY
+
+    def __init__(self, driver, queue):
+        self.driver = driver
+        self.queue = queue
+
+    def yell_set(self):
+        self.driver.toggle_pause()
+
+    def request_more(self):
+        self.driver.skip(self.SKIP)
+
+    def select_card(self, card, x, y):
+        pass
+
+    def deselect_card(self, card, x, y):
+        pass
+
+    def check_set(self):
+        pass
+
+    def disconnect(self):
+        self.driver.stop()
+        self.queue.enqueue_msg('end_game', message="Replay stopped")
+
+def run_replay(stdscr, path, speed=1.0, start=0):
+    import ui
+    from control_queue import ControlQueue
+
+    ui.Color.init()
+    board = ui.Board(stdscr)
+    board.init()
+    queue = ControlQueue()
+
+    reader = ArchiveReader(path)
+    driver = ReplayDriver(reader, queue.enqueue_obj, float(speed))
+    controller = ui.LocalController(board, ReplayHost(driver, queue), queue)
+
+    rtn = []
+    control_thread = Thread(target = controller.control_loop,
+                            args = (stdscr, rtn))
+    control_thread.start()
+
+    driver.seek(int(start))
+    driver.play()
+    if not driver.stopped:
+        queue.enqueue_msg('end_game', message="End of replay")
+    control_thread.join()
+    reader.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or len(sys.argv) > 4:
+        print("Usage: python %s <archive> [speed] [start event]" % sys.argv[0])
+        exit(1)
+    import curses
+    init_logfile("53T_replay.log")
+    curses.wrapper(run_replay, *sys.argv[1:])
@@ -0,0 +1,154 @@
+from model import Card
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Finds sets by hashing the card each pair needs: for every pair on the board
+# the third card is looked up in Card.THIRD and checked against the board's ids.
+# A board is either a mapping of position => Card (e.g. Game.layout) or a
+# sequence of cards, in which case positions are indices into the sequence.
+
+def _positions(board):
+    if hasattr(board, 'items'):
+        return list(board.items())
+    return list(enumerate(board))
+
+def _iter_sets(board):
+    items = _positions(board)
+    third = Card.THIRD
+    index = {card.id: i for i, (_, card) in enumerate(items)}
+    for i in range(len(items)):
+        row = third[items[i][1].id]
+        for j in range(i + 1, len(items)):
+            k = index.get(row[items[j][1].id])
+            # Only report each set once, from its two lowest-indexed cards
+            if k is not None and k > j:
+                yield items[i][0], items[j][0], items[k][0]
+
+def has_set(board):
+    for _ in _iter_sets(board):
+        return True
+    return False
+
+def count_sets(board):
+    return sum(1 for _ in _iter_sets(board))
+
+def find_set(board):
+    for positions in _iter_sets(board):
+        return positions
+    return None
+
+def find_all_sets(board):
+    return list(_iter_sets(board))
+
+# Batch mode: boards is an (n_boards, n_cards) array of card ids, with
+# rows padded by -1 where a board holds fewer cards
+
+_THIRD_ARRAY = None
+
+def _third_array():
+    global _THIRD_ARRAY
+    if _THIRD_ARRAY is None:
+        _THIRD_ARRAY = numpy.array(Card.THIRD, dtype=numpy.int16)
+    return _THIRD_ARRAY
+
+def batch_count_sets(boards):
+    if numpy is None:
+        raise RuntimeError("Batch set finding requires numpy")
+    boards = numpy.asarray(boards, dtype=numpy.int16)
+    if boards.ndim != 2:
+        raise ValueError("Boards must be a 2-d array of card ids")
+    n_boards, n_cards = boards.shape
+    rows = numpy.arange(n_boards)[:, None]
+
+    present = numpy.zeros((n_boards, Card.N_CARDS + 1), dtype=bool)
+    # Padding (-1) lands in the extra last column, which is never a needed card
+    present[rows, boards] = True
+    present[:, -1] = False
+
+    i, j = numpy.triu_indices(n_cards, 1)
+    a, b = boards[:, i], boards[:, j]
+    valid = (a >= 0) & (b >= 0)
+    needed = _third_array()[numpy.maximum(a, 0), numpy.maximum(b, 0)]
+    hits = present[rows, needed] & valid
+    # Each set is found once for each of its three pairs
+    return hits.sum(axis=1) // 3
+
+def batch_has_set(boards):
+    return batch_count_sets(boards) > 0
+
+def boards_to_array(boards, width=None):
+    if numpy is None:
+        raise RuntimeError("Batch set finding requires numpy")
+    boards = [[card.id for _, card in _positions(board)] for board in boards]
+    if width is None:
+        width = max(len(b) for b in boards) if boards else 0
+    array = numpy.full((len(boards), width), -1, dtype=numpy.int16)
+    for row, ids in enumerate(boards):
+        array[row, :len(ids)] = ids
+    return array
+
+class SetIndex:
+
+    # Live index of every set on a board, updated as cards are placed and
+    # removed. Adding or removing a card costs O(cards on board); queries are O(1)
+
+    def __init__(self):
+        self.cards = {}
+        # card id => position
+        self.positions = {}
+        # Every set as a frozenset of positions
+        self.sets = set()
+        # position => sets containing that position
+        self.by_position = {}
+
+    def add(self, pos, card):
+        if pos in self.cards:
+            self.remove(pos)
+        row = Card.THIRD[card.id]
+        containing = set()
+        for other_pos, other in self.cards.items():
+            third_pos = self.positions.get(row[other.id])
+            if third_pos is not None:
+                containing.add(frozenset((pos, other_pos, third_pos)))
+        self.cards[pos] = card
+        self.positions[card.id] = pos
+        self.by_position[pos] = containing
+        for s in containing:
+            self.sets.add(s)
+            for p in s:
+                if p != pos:
+                    self.by_position[p].add(s)
+
+    def remove(self, pos):
+        card = self.cards.pop(pos, None)
+        if card is None:
+            return
+        del self.positions[card.id]
+        for s in self.by_position.pop(pos):
+            self.sets.discard(s)
+            for p in s:
+                if p != pos:
+                    self.by_position[p].discard(s)
+
+    def clear(self):
+        self.cards.clear()
+        self.positions.clear()
+        self.sets.clear()
+        self.by_position.clear()
+
+    def has_set(self):
+        return len(self.sets) > 0
+
+    def count_sets(self):
+        return len(self.sets)
+
+    def find_set(self):
+        for s in self.sets:
+            return tuple(s)
+        return None
+
+    def find_all_sets(self):
+        return [tuple(s) for s in self.sets]
@@ -0,0 +1,164 @@
+import sys
+import json
+import random
+import multiprocessing
+from host import Game
+from logger import *
+
+class NullClient:
+
+    def __init__(self, id):
+        self.id = id
+
+class NullSession:
+
+    # Stands in for RemoteSession/LocalSession: every session call is a no-op
+
+    def __init__(self, num_players=1):
+        self.clients = [NullClient(id + 1) for id in range(num_players)]
+        for method_name in Game.SESSION_CALLS:
+            setattr(self, method_name, self._ignore)
+
+    def _ignore(self, *args, **kwargs):
+        pass
+
+    def client_ids(self):
+        for client in self.clients:
+            yield client.id
+
+def play_game(seed, num_players=1, auto_deal=False):
+    random.seed(seed)
+    session = NullSession(num_players)
+    game = Game(session)
+    game.AUTO_DEAL = auto_deal
+    game.fill_board()
+
+    stats = dict(
+        seed = seed,
+        initial_no_set = not game.has_set(),
+        sets = 0,
+        extra_deals = 0,
+        no_set_boards = 0,
+    )
+
+    while True:
+        found = game.find_set()
+        if found is None:
+            stats['no_set_boards'] += 1
+            if game.cards_remain() and len(game.layout) + 3 <= game.MAX_CARDS:
+                game.place_three()
+                stats['extra_deals'] += 1
+                continue
+            break
+
+        client = session.clients[stats['sets'] % num_players]
+        game.yell_set(client)
+        for x, y in found:
+            game.select_card(game.card_at(x, y), x, y)
+        stats['sets'] += 1
+        if game.check_set(client):
+            break
+
+    stats['cards_left'] = len(game.layout)
+    stats['deck_left'] = game.deck.cards_remaining()
+    # A full board with no set and cards still in the deck: the game can't go on
+    stats['stuck'] = game.cards_remain()
+    return stats
+
+class Aggregate:
+
+    HISTOGRAMS = ('sets', 'extra_deals', 'no_set_boards', 'cards_left')
+
+    def __init__(self):
+        self.games = 0
+        self.initial_no_set = 0
+        self.stuck = 0
+        self.histograms = {name: {} for name in self.HISTOGRAMS}
+
+    def add_game(self, stats):
+        self.games += 1
+        self.initial_no_set += stats['initial_no_set']
+        self.stuck += stats['stuck']
+        for name in self.HISTOGRAMS:
+            hist = self.histograms[name]
+            key = str(stats[name])
+            hist[key] = hist.get(key, 0) + 1
+
+    def merge(self, other):
+        self.games += other['games']
+        self.initial_no_set += other['initial_no_set']
+        self.stuck += other['stuck']
+        for name in self.HISTOGRAMS:
+            hist = self.histograms[name]
+            for key, count in other['histograms'][name].items():
+                hist[key] = hist.get(key, 0) + count
+
+    def mean(self, name):
+        hist = self.histograms[name]
+        if self.games == 0:
+            return 0
+        return sum(int(k) * v for k, v in hist.items()) / float(self.games)
+
+    def dict(self):
+        return dict(
+            games = self.games,
+            initial_no_set = self.initial_no_set,
+            stuck = self.stuck,
+            histograms = self.histograms,
+        )
+
+    def summary(self):
+        rtn = self.dict()
+        if self.games > 0:
+            rtn['initial_no_set_rate'] = self.initial_no_set / float(self.games)
+            rtn['stuck_rate'] = self.stuck / float(self.games)
+            for name in self.HISTOGRAMS:
+                rtn['mean_' + name] = self.mean(name)
+        return rtn
+
+def run_chunk(args):
+    first_seed, n_games, num_players, auto_deal = args
+    agg = Aggregate()
+    for seed in range(first_seed, first_seed + n_games):
+        agg.add_game(play_game(seed, num_players, auto_deal))
+    rtn = agg.dict()
+    rtn['first_seed'] = first_seed
+    return rtn
+
+def simulate(n_games, output=None, first_seed=0, processes=None,
+             num_players=1, auto_deal=False, chunk_size=1000):
+    chunks = [(seed, min(chunk_size, first_seed + n_games - seed), num_players, auto_deal)
+              for seed in range(first_seed, first_seed + n_games, chunk_size)]
+    total = Aggregate()
+    out = open(output, 'a') if output is not None else None
+    pool = multiprocessing.Pool(processes)
+    try:
+        # Each finished chunk is written as it arrives, then a final summary line
+        for result in pool.imap_unordered(run_chunk, chunks):
+            total.merge(result)
+            if out is not None:
+                out.write(json.dumps(dict(chunk=result)) + '\n')
+                out.flush()
+            log("Simulated %d/%d games", total.games, n_games)
+        summary = total.summary()
+        if out is not None:
+            out.write(json.dumps(dict(summary=summary)) + '\n')
+        return summary
+    finally:
+        pool.close()
+        pool.join()
+        if out is not None:
+            out.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or len(sys.argv) > 5:
+        print("Usage: python %s <# games> [output.jsonl] [first seed] [# processes]" % sys.argv[0])
+        exit(1)
+    n_games = int(sys.argv[1])
+    output = sys.argv[2] if len(sys.argv) > 2 else None
+    first_seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    processes = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    summary = simulate(n_games, output, first_seed, processes)
+    for key in sorted(summary):
+        if key != 'histograms':
+            print("%s: %s" % (key, summary[key]))
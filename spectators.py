@@ -0,0 +1,128 @@
+import itertools
+import protocol
+from logger import *
+
+LOG = get_log('spectators')
+
+class SpectatorFeed:
+
+    # Read-only watchers of one game. Session calls are only recorded as they
+    # happen; every FLUSH_DELAY the batch is encoded once per codec in use and
+    # the same bytes are written to every watcher, so an event costs about the
+    # same with a thousand watchers as with one, and players never wait on
+    # spectators' sockets.
+    #
+    # A watcher joins with one snapshot of the board, sent at a flush after
+    # the events that snapshot already includes, then follows the event
+    # stream. One that falls behind far enough to overflow its outbound queue
+    # is resynced the same way.
+
+    FLUSH_DELAY = 0.05
+
+    def __init__(self, timers, snapshot_source=None):
+        self.timers = timers
+        # Returns the (type, args, kwargs) that shows a watcher the whole
+        # game, or None before there is one
+        self.snapshot_source = snapshot_source
+        self.watching = set()
+        # Snapshotted and moved to watching at the next flush
+        self.joining = set()
+        self.events = []
+        self.timer = None
+        # Being resynced: skips the events its snapshot already covers
+        self.resyncing = None
+
+    def __len__(self):
+        return len(self.watching) + len(self.joining)
+
+    def add(self, conn):
+        if conn in self.watching or conn in self.joining:
+            return
+        conn.snapshot_source = lambda: self.resync(conn)
+        self.joining.add(conn)
+        self.schedule()
+        LOG.debug("Spectator joined (%d watching)", len(self))
+
+    def remove(self, conn):
+        self.watching.discard(conn)
+        self.joining.discard(conn)
+
+    def publish(self, type, args, kwargs):
+        if not self.watching and not self.joining:
+            return
+        self.events.append((type, args, kwargs))
+        self.schedule()
+
+    def schedule(self):
+        if self.timer is None:
+            self.timer = self.timers.schedule(self.FLUSH_DELAY, self.flush)
+
+    def snapshot(self):
+        snapshot = self.snapshot_source() if self.snapshot_source is not None else None
+        if snapshot is None:
+            return 'board_snapshot', [[]], {}
+        return snapshot
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        events, self.events = self.events, []
+        # Encode once per codec in use, not once per watcher. Events that must
+        # be delivered go in frames of their own, which the one being
+        # resynced gets too: its snapshot cannot stand in for them.
+        for keep, run in itertools.groupby(events, lambda event: event[0] in protocol.MUST_DELIVER):
+            run = list(run)
+            frames = {}
+            for conn in list(self.watching):
+                if conn is self.resyncing and not keep:
+                    continue
+                data = self.frame(frames, conn, run)
+                if data is not None:
+                    conn.send(data, keep)
+        if self.joining:
+            joining, self.joining = self.joining, set()
+            snapshot = [self.snapshot()]
+            frames = {}
+            for conn in joining:
+                if conn.closed:
+                    continue
+                data = self.frame(frames, conn, snapshot)
+                if data is not None:
+                    conn.send(data)
+                    self.watching.add(conn)
+
+    def frame(self, frames, conn, events):
+        # events encoded for conn, shared through frames with every watcher
+        # on the same codec; None, and conn dropped, if they cannot be
+        key = conn.out_codec if conn.negotiated else None
+        data = frames.get(key)
+        if data is None:
+            try:
+                data = b''.join(protocol.frame_for(conn, type, args, kwargs)
+                                for type, args, kwargs in events)
+            except protocol.FrameTooLarge as e:
+                log_warn("Dropping spectators that cannot be sent a message: %s", e)
+                data = False
+            frames[key] = data
+        if data is False:
+            conn.abort()
+            return None
+        return data
+
+    def resync(self, conn):
+        # conn's outbound queue drained after overflowing. Everyone else gets
+        # the pending events first, so the snapshot covers exactly what conn
+        # missed.
+        self.resyncing = conn
+        try:
+            self.flush()
+        finally:
+            self.resyncing = None
+        return self.snapshot()
+
+    def close(self):
+        self.flush()
+        for conn in self.watching:
+            conn.close()
+        self.watching.clear()
@@ -0,0 +1,275 @@
+import os
+import re
+import sys
+import socket
+import asyncio
+import multiprocessing
+from lobby import LobbyServer
+from host_communication import optional
+from timers import TimerWheel
+from logger import *
+
+LOG = get_log('supervisor')
+
+# Workers start from a fresh interpreter rather than a fork, so they inherit
+# neither the supervisor's event loop nor its listening socket
+CONTEXT = multiprocessing.get_context('spawn')
+
+class WorkerLobby(LobbyServer):
+
+    # A lobby that does not listen: the supervisor accepts connections and
+    # passes their sockets over channel. Every so often it reports back how
+    # many it has taken, how many are still open and how many of those are
+    # not in a match yet.
+
+    REPORT_DELAY = 0.05
+
+    def __init__(self, channel, index, players_per_match, ip='127.0.0.1', metrics_port=None):
+        LobbyServer.__init__(self, ip, players_per_match=players_per_match,
+                             metrics_port=metrics_port)
+        self.channel = channel
+        self.index = index
+        self.accepted = 0
+        self.report_timer = None
+        self.stopped = None
+
+    async def serve(self):
+        loop = asyncio.get_event_loop()
+        self.timers.attach(loop)
+        self.stopped = loop.create_future()
+        self.channel.setblocking(False)
+        loop.add_reader(self.channel.fileno(), self.receive)
+        metrics_server = await self.serve_metrics()
+        log("Worker %d ready", self.index)
+        try:
+            await self.stopped
+        finally:
+            loop.remove_reader(self.channel.fileno())
+            if metrics_server is not None:
+                metrics_server.close()
+
+    def receive(self):
+        loop = asyncio.get_event_loop()
+        try:
+            msg, fds, _, _ = socket.recv_fds(self.channel, 16, 16)
+        except BlockingIOError:
+            return
+        if not msg:
+            log_warn("Worker %d lost its supervisor", self.index)
+            if not self.stopped.done():
+                self.stopped.set_result(None)
+            return
+        for fd in fds:
+            sock = socket.socket(fileno=fd)
+            loop.create_task(loop.connect_accepted_socket(self.connection, sock))
+
+    def client_joined(self, conn):
+        LobbyServer.client_joined(self, conn)
+        # The supervisor routes a returning player back here by this prefix
+        client = self.clients[conn]
+        client.token = 'w%d-%s' % (self.index, client.token)
+        self.accepted += 1
+        self.schedule_report()
+
+    def client_left(self, conn):
+        LobbyServer.client_left(self, conn)
+        self.schedule_report()
+
+    def form_matches(self):
+        LobbyServer.form_matches(self)
+        self.schedule_report()
+
+    def schedule_report(self):
+        if self.report_timer is None:
+            self.report_timer = self.timers.schedule(self.REPORT_DELAY, self.report)
+
+    def report(self):
+        self.report_timer = None
+        unmatched = sum(1 for client in self.clients.values() if client.match is None)
+        try:
+            self.channel.send(b'%d %d %d' % (self.accepted, len(self.clients), unmatched))
+        except OSError:
+            # Full, or the supervisor is gone: the next report supersedes it
+            pass
+
+def run_worker(channel, index, players_per_match, log_level, ip, metrics_port):
+    init_stdoutlog(log_level)
+    lobby = WorkerLobby(channel, index, players_per_match, ip, metrics_port)
+    asyncio.run(lobby.serve())
+
+class Worker:
+
+    # The supervisor's end of one worker process
+
+    def __init__(self, index, players_per_match, log_level, ip='127.0.0.1', metrics_port=None):
+        self.index = index
+        self.channel, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.process = CONTEXT.Process(target=run_worker, daemon=True,
+                                       args=(child, index, players_per_match, log_level,
+                                             ip, metrics_port))
+        self.process.start()
+        child.close()
+        self.channel.setblocking(False)
+        # Handed over by the supervisor, and as of the last report
+        self.handed = 0
+        self.accepted = 0
+        self.open = 0
+        self.unmatched = 0
+
+    def in_flight(self):
+        return self.handed - self.accepted
+
+    def load(self):
+        return self.open + self.in_flight()
+
+    def short(self, players_per_match):
+        # Players still needed for the unmatched ones here to make up matches
+        return -(self.unmatched + self.in_flight()) % players_per_match
+
+    def hand_off(self, sock):
+        socket.send_fds(self.channel, [b'+'], [sock.fileno()])
+        self.handed += 1
+
+    def read_reports(self):
+        # False once the worker has gone
+        while True:
+            try:
+                data = self.channel.recv(64)
+            except BlockingIOError:
+                return True
+            except OSError:
+                return False
+            if not data:
+                return False
+            self.accepted, self.open, self.unmatched = map(int, data.split())
+
+    def close(self):
+        self.channel.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+
+class Supervisor:
+
+    # Accepts every connection and hands its socket to one of several lobby
+    # worker processes, so games run on as many cores as there are workers.
+    # A match's players must all be in one process, so new players go first
+    # to a worker with players still waiting for a match, and otherwise to
+    # the least loaded one; running games never move. A returning player's
+    # session token names their worker. Workers that die are restarted;
+    # their games are lost. With a metrics port, worker i serves its
+    # metrics on metrics port + i.
+
+    WORKERS = os.cpu_count() or 1
+    CHECK_INTERVAL = 1
+
+    # How long to wait for a new connection's first bytes, in case they are
+    # a resume_session to route back to the worker holding the seat
+    ROUTE_WAIT = 0.1
+    PEEK_SIZE = 1024
+    RESUME = re.compile(rb'"resume_session"[^\[]*\[\s*"w(\d+)-')
+
+    def __init__(self, ip='127.0.0.1', port=9999, workers=WORKERS,
+                 players_per_match=LobbyServer.PLAYERS_PER_MATCH, metrics_port=None):
+        self.ip = ip
+        self.port = port
+        self.metrics_port = metrics_port
+        self.num_workers = workers
+        self.players_per_match = players_per_match
+        self.workers = []
+        self.timers = TimerWheel()
+        self.log_level = get_log().threshold
+
+    async def serve(self):
+        loop = asyncio.get_event_loop()
+        self.timers.attach(loop)
+        for index in range(self.num_workers):
+            self.start_worker(index)
+        self.timers.schedule(self.CHECK_INTERVAL, self.check)
+        listener = socket.create_server((self.ip, self.port))
+        listener.setblocking(False)
+        log("Supervising %d workers on %s:%d", self.num_workers, self.ip, self.port)
+        try:
+            while True:
+                sock, _ = await loop.sock_accept(listener)
+                loop.create_task(self.route(sock))
+        finally:
+            listener.close()
+            for worker in self.workers:
+                loop.remove_reader(worker.channel.fileno())
+                worker.close()
+
+    def start_worker(self, index):
+        metrics_port = self.metrics_port + index if self.metrics_port is not None else None
+        worker = Worker(index, self.players_per_match, self.log_level, self.ip, metrics_port)
+        if index < len(self.workers):
+            self.workers[index] = worker
+        else:
+            self.workers.append(worker)
+        asyncio.get_event_loop().add_reader(worker.channel.fileno(), self.reported, worker)
+
+    def reported(self, worker):
+        if not worker.read_reports():
+            self.restart(worker)
+
+    def restart(self, worker):
+        if self.workers[worker.index] is not worker:
+            return
+        asyncio.get_event_loop().remove_reader(worker.channel.fileno())
+        worker.close()
+        log_warn("Worker %d exited (%s): restarting it", worker.index, worker.process.exitcode)
+        self.start_worker(worker.index)
+
+    def check(self):
+        for worker in list(self.workers):
+            if not worker.process.is_alive():
+                self.restart(worker)
+        self.timers.schedule(self.CHECK_INTERVAL, self.check)
+
+    async def route(self, sock):
+        loop = asyncio.get_event_loop()
+        readable = loop.create_future()
+        loop.add_reader(sock.fileno(), lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait_for(readable, self.ROUTE_WAIT)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            loop.remove_reader(sock.fileno())
+        try:
+            first = sock.recv(self.PEEK_SIZE, socket.MSG_PEEK)
+        except OSError:
+            first = b''
+        resume = self.RESUME.search(first)
+        try:
+            if resume is not None and int(resume.group(1)) < len(self.workers):
+                choices = [self.workers[int(resume.group(1))]]
+            else:
+                choices = sorted(self.workers, key=self.preference)
+            for worker in choices:
+                try:
+                    worker.hand_off(sock)
+                    return
+                except OSError:
+                    log_warn("Could not hand a connection to worker %d", worker.index)
+            log_warn("Dropping connection: no worker could take it")
+        finally:
+            # The worker has its own copy of the socket now
+            sock.close()
+
+    def preference(self, worker):
+        short = worker.short(self.players_per_match)
+        return (short == 0, short, worker.load())
+
+def run_supervisor(ip='127.0.0.1', port=9999, workers=Supervisor.WORKERS,
+                   players_per_match=LobbyServer.PLAYERS_PER_MATCH, metrics_port=None):
+    supervisor = Supervisor(ip, int(port), int(workers), int(players_per_match),
+                            optional(metrics_port, int))
+    asyncio.run(supervisor.serve())
+
+if __name__ == '__main__':
+    init_stdoutlog()
+    if len(sys.argv) > 6:
+        print("Usage: python %s [ip] [port] [# workers] [# players per match] [metrics port]" % sys.argv[0])
+        exit(1)
+    run_supervisor(*sys.argv[1:])
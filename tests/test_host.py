@@ -0,0 +1,66 @@
+import time
+import socket
+import threading
+from host import Game
+from host_communication import HostReceiver, RemoteSession
+from simulator import NullSession
+
+def message(type, *args):
+    return dict(type=type, args=list(args), kwargs={})
+
+def test_unknown_card_is_ignored():
+    session = NullSession(2)
+    game = Game(session)
+    receiver = HostReceiver(game)
+    player = session.clients[0]
+    receiver.handle_message(message('start'), player)
+    receiver.handle_message(message('yell_set'), player)
+
+    for bad in (['z', 'z', 'z', 9], ['r', 's'], 'rse1', None):
+        assert receiver.handle_message(message('select_card', bad, 0, 0), player) is None
+        assert receiver.handle_message(message('deselect_card', bad, 0, 0), player) is None
+    assert not game.selected
+
+    # The game is still on: a real card can be selected
+    card = game.layout[(0, 0)]
+    receiver.handle_message(message('select_card', list(card.properties), 0, 0), player)
+    assert game.selected == {(0, 0): card}
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def join(port):
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(b'{"type": "start", "args": [], "kwargs": {}}~')
+    # Give the host a moment to take the message in
+    time.sleep(0.2)
+    return sock
+
+def test_player_leaving_before_start_gives_up_seat():
+    port = free_port()
+    sessions = []
+    thread = threading.Thread(target=lambda: sessions.append(RemoteSession('127.0.0.1', port, 2)),
+                              daemon=True)
+    thread.start()
+    time.sleep(0.2)
+
+    leaver = join(port)
+    leaver.close()
+    time.sleep(0.2)
+    players = [join(port), join(port)]
+    thread.join(5)
+    assert sessions, "the game never started"
+    session = sessions[0]
+
+    assert sorted(session.client_ids()) == [1, 2]
+    handled = []
+    def handler(msg, client):
+        handled.append((msg['type'], client.id))
+        return len(handled) == 2
+    session.run(handler)
+    # Both players' starts, and no disconnect to end the game at once
+    assert sorted(handled) == [('start', 1), ('start', 2)]
+    for sock in players:
+        sock.close()
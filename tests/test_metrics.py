@@ -0,0 +1,48 @@
+import metrics
+from transport import Connection
+
+class Transport:
+
+    # Just enough of an asyncio transport for a Connection to write to
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    def is_closing(self):
+        return False
+
+    def get_write_buffer_size(self):
+        return 0
+
+def sample(text, name, labels=''):
+    prefix = '%s%s%s ' % (metrics.PREFIX, name, labels)
+    values = [line[len(prefix):] for line in text.splitlines() if line.startswith(prefix)]
+    assert len(values) == 1, (name, values)
+    return float(values[0])
+
+def test_outbound_queue_stats_exported():
+    conn = Connection(lambda msg, conn: None, outbound_limit=10, overflow_policy='drop')
+    conn.transport = Transport()
+    conn.local, conn.peer = 'host:1', 'peer:2'
+    metrics.connection_opened(conn)
+    before = sample(metrics.exposition(), 'outbound_dropped_total')
+
+    conn.outbound.pause()
+    conn.send(b'12345678')
+    conn.send(b'too much')
+    labels = '{local="host:1",peer="peer:2"}'
+    text = metrics.exposition()
+    assert sample(text, 'connection_outbound_depth', labels) == 1
+    assert sample(text, 'connection_outbound_bytes', labels) == 8
+    assert sample(text, 'connection_outbound_dropped', labels) == 1
+    assert sample(text, 'connection_outbound_overflows', labels) == 1
+    assert sample(text, 'outbound_dropped_total') == before + 1
+
+    # Counts outlive the connection in the totals
+    metrics.connection_closed(conn)
+    text = metrics.exposition()
+    assert 'peer="peer:2"' not in text
+    assert sample(text, 'outbound_dropped_total') == before + 1
@@ -0,0 +1,70 @@
+import os
+import random
+import multiprocessing
+from host import Game
+from replay import ArchiveWriter, ArchiveReader, ArchiveSession
+from simulator import NullSession
+
+def play(path, sets, resume=False, crash=True):
+    # Plays sets sets into the archive at path, then dies without closing it
+    random.seed(sets)
+    writer = ArchiveWriter(path, resume=resume)
+    session = ArchiveSession(NullSession(2), writer)
+    game = Game(session)
+    game.fill_board()
+    done = 0
+    while done < sets:
+        found = game.find_set()
+        if found is None:
+            if game.cards_remain() and len(game.layout) + 3 <= game.MAX_CARDS:
+                game.place_three()
+                continue
+            break
+        client = session.clients[done % 2]
+        done += 1
+        game.yell_set(client)
+        for x, y in found:
+            game.select_card(game.card_at(x, y), x, y)
+        game.check_set(client)
+    if crash:
+        os._exit(1)
+    writer.close()
+
+def crash_writer(path, sets, resume=False):
+    process = multiprocessing.Process(target=play, args=(path, sets, resume))
+    process.start()
+    process.join()
+    assert process.exitcode == 1
+
+def test_crashed_archive_replays(tmp_path):
+    path = str(tmp_path / 'game.53tr')
+    crash_writer(path, 20)
+
+    reader = ArchiveReader(path)
+    try:
+        # Everything up to the last keyframe reached the disk
+        assert reader.n_events >= ArchiveWriter.KEYFRAME_EVERY
+        events = list(reader.events())
+        assert [e[0] for e in events] == list(range(reader.n_events))
+        assert reader.state_at(reader.n_events).layout
+        assert reader.duration >= 0
+    finally:
+        reader.close()
+
+def test_resumed_archive_continues(tmp_path):
+    path = str(tmp_path / 'game.53tr')
+    crash_writer(path, 20)
+    reader = ArchiveReader(path)
+    kept = reader.n_events
+    reader.close()
+
+    play(path, 5, resume=True, crash=False)
+    reader = ArchiveReader(path)
+    try:
+        assert reader.n_events > kept
+        times = [t for _, t, _ in reader.events()]
+        assert times == sorted(times)
+        # The resumed game's board follows straight on from the old events
+        assert [msg['type'] for _, _, msg in reader.events(kept, kept + 1)] == ['board_snapshot']
+    finally:
+        reader.close()
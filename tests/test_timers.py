@@ -0,0 +1,71 @@
+from timers import TimerWheel
+
+class Clock:
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class Loop:
+
+    # Stands in for the asyncio loop: call_later callbacks run in time
+    # order as run() moves the clock forward to each
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.calls = []
+        self.wakeups = 0
+
+    def call_later(self, delay, fn):
+        call = Call(self.clock() + delay, fn)
+        self.calls.append(call)
+        return call
+
+    def run(self):
+        while True:
+            calls = [call for call in self.calls if not call.cancelled]
+            if not calls:
+                return
+            call = min(calls, key=lambda call: call.when)
+            self.calls.remove(call)
+            # A real loop wakes a little after the deadline, never exactly on it
+            self.clock.now = max(self.clock.now, call.when + 1e-6)
+            self.wakeups += 1
+            call.fn()
+
+class Call:
+
+    def __init__(self, when, fn):
+        self.when = when
+        self.fn = fn
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+def test_timer_in_level_zero_wakes_once():
+    clock = Clock()
+    loop = Loop(clock)
+    wheel = TimerWheel(clock=clock)
+    wheel.attach(loop)
+    fired = []
+    # 200 ticks out: in level 0, which spans 256
+    wheel.schedule(2, lambda: fired.append(clock()))
+    loop.run()
+    assert fired and fired[0] >= 1002
+    # Once when it is due, plus at most one boundary the wheel crosses
+    assert loop.wakeups <= 2
+
+def test_distant_timer_wakes_few_times():
+    clock = Clock()
+    loop = Loop(clock)
+    wheel = TimerWheel(clock=clock)
+    wheel.attach(loop)
+    fired = []
+    wheel.schedule(30, lambda: fired.append(clock()))
+    loop.run()
+    assert fired and fired[0] >= 1030
+    # Once to cascade it out of level 1, and once when it is due
+    assert loop.wakeups <= 2
@@ -0,0 +1,156 @@
+import time
+from logger import *
+
+LOG = get_log('timers')
+
+class Timer:
+
+    __slots__ = ('wheel', 'expires', 'fn', 'args', 'bucket', 'level')
+
+    def __init__(self, wheel, expires, fn, args):
+        self.wheel = wheel
+        # In ticks
+        self.expires = expires
+        self.fn = fn
+        self.args = args
+        self.bucket = None
+        self.level = None
+
+    def cancel(self):
+        if self.bucket is not None:
+            self.bucket.discard(self)
+            self.bucket = None
+            self.wheel.level_counts[self.level] -= 1
+            self.wheel.count -= 1
+
+    @property
+    def pending(self):
+        return self.bucket is not None
+
+class TimerWheel:
+
+    # Hierarchical timing wheel. Level 0 has SLOTS buckets of one TICK each;
+    # every level above has SLOTS buckets each as wide as the whole level
+    # below. A timer goes into the lowest level whose span reaches it and
+    # drops a level each time the level below wraps around, so scheduling and
+    # cancelling are O(1) however many timers are pending.
+
+    TICK = 0.01
+    BITS = 8
+    SLOTS = 1 << BITS
+    LEVELS = 4
+
+    def __init__(self, tick=TICK, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.current = int(clock() / tick)
+        self.levels = [[set() for _ in range(self.SLOTS)] for _ in range(self.LEVELS)]
+        self.level_counts = [0] * self.LEVELS
+        self.count = 0
+        # Set by attach(): the asyncio loop that advances the wheel
+        self.loop = None
+        self.handle = None
+        self.armed_for = None
+
+    def schedule(self, delay, fn, *args):
+        # Runs fn(*args) once delay seconds have passed (rounded up to a tick)
+        if self.count == 0:
+            # Nothing can be missed: skip the idle ticks rather than walk them
+            self.current = max(self.current, int(self.clock() / self.tick))
+        expires = max(self.current + 1, -int(-(self.clock() + delay) // self.tick))
+        timer = Timer(self, expires, fn, args)
+        self.add(timer)
+        self.count += 1
+        self.arm()
+        return timer
+
+    def add(self, timer):
+        delta = timer.expires - self.current
+        for level in range(self.LEVELS):
+            if delta < 1 << (self.BITS * (level + 1)) or level == self.LEVELS - 1:
+                break
+        # Past the top level's span: park it as far out as it reaches
+        expires = min(timer.expires, self.current + (1 << (self.BITS * self.LEVELS)) - 1)
+        bucket = self.levels[level][(expires >> (self.BITS * level)) & (self.SLOTS - 1)]
+        bucket.add(timer)
+        timer.bucket = bucket
+        timer.level = level
+        self.level_counts[level] += 1
+
+    def cascade(self, level):
+        # Moves the timers in level's current bucket down; True if that
+        # bucket was index 0, so the level above is due to cascade too
+        index = (self.current >> (self.BITS * level)) & (self.SLOTS - 1)
+        bucket = self.levels[level][index]
+        timers = list(bucket)
+        bucket.clear()
+        self.level_counts[level] -= len(timers)
+        for timer in timers:
+            self.add(timer)
+        return index == 0
+
+    def next_tick(self):
+        # The first tick on which anything can fire or cascade: that of the
+        # lowest non-empty level's first occupied bucket, if it comes before
+        # the level wraps around, and otherwise the wrap itself. The levels
+        # below are empty, so no tick in between has anything to do.
+        level = 0
+        while self.level_counts[level] == 0:
+            level += 1
+        shift = self.BITS * level
+        buckets = self.levels[level]
+        position = self.current >> shift
+        for index in range((position & (self.SLOTS - 1)) + 1, self.SLOTS):
+            if buckets[index]:
+                return ((position & ~(self.SLOTS - 1)) | index) << shift
+        return (self.current | ((1 << (shift + self.BITS)) - 1)) + 1
+
+    def advance(self, now=None):
+        # Runs every timer due by now; returns how many ran
+        if now is None:
+            now = self.clock()
+        target = int(now / self.tick)
+        ran = 0
+        while self.count > 0:
+            tick = self.next_tick()
+            if tick > target:
+                break
+            self.current = tick
+            if self.current & (self.SLOTS - 1) == 0:
+                level = 1
+                while level < self.LEVELS and self.cascade(level):
+                    level += 1
+            bucket = self.levels[0][self.current & (self.SLOTS - 1)]
+            while bucket:
+                timer = bucket.pop()
+                timer.bucket = None
+                self.level_counts[0] -= 1
+                self.count -= 1
+                ran += 1
+                try:
+                    timer.fn(*timer.args)
+                except Exception:
+                    log_error("Timer %s failed", timer.fn, exc_info=True)
+        self.current = max(self.current, target)
+        return ran
+
+    def attach(self, loop):
+        # Let loop advance the wheel, waking only when a timer may be due
+        self.loop = loop
+        self.arm()
+
+    def arm(self):
+        if self.loop is None or self.count == 0:
+            return
+        tick = self.next_tick()
+        if self.handle is not None:
+            if self.armed_for <= tick:
+                return
+            self.handle.cancel()
+        self.armed_for = tick
+        self.handle = self.loop.call_later(max(0, tick * self.tick - self.clock()), self.on_tick)
+
+    def on_tick(self):
+        self.handle = None
+        self.advance()
+        self.arm()
@@ -0,0 +1,366 @@
+import asyncio
+import itertools
+import contextlib
+import collections
+import protocol
+import metrics
+from logger import *
+
+def address(addr):
+    return '%s:%s' % addr[:2] if isinstance(addr, tuple) else str(addr)
+
+class OutboundQueue:
+
+    # Frames waiting for a connection whose transport has asked us to stop
+    # writing (pause_writing). Bounded at `limit` bytes; what happens to a
+    # client that falls further behind than that is set by `policy`:
+    #   drop       - discard the frames that don't fit
+    #   snapshot   - discard everything queued and send one fresh snapshot
+    #                from conn.snapshot_source() once the client catches up
+    #                (disconnect if that returns None)
+    #   disconnect - drop the connection
+    # Frames pushed with keep (see protocol.MUST_DELIVER) are never dropped
+    # while the connection stays up; a snapshot is followed by those kept.
+
+    POLICIES = ('drop', 'snapshot', 'disconnect')
+
+    def __init__(self, conn, limit, policy):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown overflow policy %s" % policy)
+        self.conn = conn
+        self.limit = limit
+        self.policy = policy
+        # (data, keep) pairs
+        self.frames = collections.deque()
+        self.bytes = 0
+        self.paused = False
+        self.needs_snapshot = False
+        self.overflowing = False
+
+        self.max_bytes = 0
+        self.dropped = 0
+        self.snapshots = 0
+        self.overflows = 0
+
+    def push(self, data, keep=False):
+        if self.needs_snapshot:
+            # The snapshot sent on resume supersedes anything queued meanwhile
+            if keep:
+                self.append(data, keep)
+            else:
+                self.dropped += 1
+            return
+        if not self.paused and not self.frames:
+            self.write(data)
+            return
+        if self.bytes + len(data) > self.limit:
+            self.overflow(data, keep)
+            return
+        self.append(data, keep)
+
+    def append(self, data, keep):
+        self.frames.append((data, keep))
+        self.bytes += len(data)
+        self.max_bytes = max(self.max_bytes, self.bytes)
+
+    def pending(self):
+        return bool(self.frames) or self.needs_snapshot
+
+    def overflow(self, data, keep=False):
+        self.overflows += 1
+        policy = self.policy
+        if policy == 'snapshot' and getattr(self.conn, 'snapshot_source', None) is None:
+            policy = 'disconnect'
+        if not self.overflowing:
+            # Once per stall, not once per dropped frame
+            self.overflowing = True
+            log_warn("Outbound queue over %d bytes: %s", self.limit, policy)
+        if policy == 'drop':
+            if keep:
+                self.append(data, keep)
+            else:
+                self.dropped += 1
+        elif policy == 'snapshot':
+            kept = [frame for frame in self.frames if frame[1]]
+            self.dropped += len(self.frames) - len(kept) + (not keep)
+            self.frames = collections.deque(kept)
+            self.bytes = sum(len(data) for data, _ in kept)
+            self.needs_snapshot = True
+            if keep:
+                self.append(data, keep)
+        else:
+            self.dropped += len(self.frames) + 1
+            self.frames.clear()
+            self.bytes = 0
+            self.conn.abort()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self.overflowing = False
+        if self.needs_snapshot:
+            self.snapshots += 1
+            # Still set while the source runs, so anything sent meanwhile
+            # is queued behind the snapshot or dropped as covered by it
+            snapshot = self.conn.snapshot_source()
+            self.needs_snapshot = False
+            if snapshot is None:
+                self.give_up("no snapshot to send")
+                return
+            try:
+                self.write(protocol.frame_for(self.conn, *snapshot))
+            except protocol.FrameTooLarge as e:
+                self.give_up(e)
+                return
+        # Writing may pause us again; whatever is left waits for the next resume
+        while self.frames and not self.paused:
+            data, _ = self.frames.popleft()
+            self.bytes -= len(data)
+            self.write(data)
+
+    def give_up(self, reason):
+        log_warn("Cannot resync connection: %s", reason)
+        self.frames.clear()
+        self.bytes = 0
+        # Not from inside resume_writing: the transport would report the
+        # connection lost twice
+        self.conn.loop.call_soon(self.conn.abort)
+
+    def write(self, data):
+        self.conn.bytes_sent += len(data)
+        self.conn.transport.write(data)
+
+    def stats(self):
+        return dict(
+            depth = len(self.frames),
+            bytes = self.bytes,
+            max_bytes = self.max_bytes,
+            transport_bytes = self.conn.transport.get_write_buffer_size()
+                              if self.conn.transport is not None else 0,
+            paused = self.paused,
+            dropped = self.dropped,
+            snapshots = self.snapshots,
+            overflows = self.overflows,
+        )
+
+class ReceiveBuffer:
+
+    # A reusable bytearray the socket reads straight into (recv_into, or
+    # asyncio's get_buffer/buffer_updated). Frames are decoded in place from
+    # data[start:end]; a partial frame left at the end stays put until the
+    # next read needs the room, when it is moved to the front. The array is
+    # never resized, only replaced when a single frame outgrows it, so views
+    # handed out for a read stay valid.
+
+    # Kept per connection, so sized for game traffic; big frames grow it
+    SIZE = 16 * 1024
+    # Move or grow rather than offer a read less room than this
+    MIN_READ = 2048
+    # Longest frame we wait for the end of; a peer that sends more without
+    # one is broken or hostile, and is dropped before the buffer grows further
+    MAX_FRAME = 1024 * 1024
+
+    def __init__(self, size=SIZE):
+        self.data = bytearray(size)
+        self.view = memoryview(self.data)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def get_buffer(self, sizehint=-1):
+        # Where the next read should land
+        if self.start == self.end:
+            self.start = self.end = 0
+        want = max(sizehint, self.MIN_READ)
+        if len(self.data) - self.end < want:
+            pending = self.end - self.start
+            if pending + want > len(self.data):
+                data = bytearray(max(2 * len(self.data), pending + want))
+                view = memoryview(data)
+                view[:pending] = self.view[self.start:self.end]
+                self.data, self.view = data, view
+            else:
+                self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        return self.view[self.end:]
+
+    def filled(self, nbytes):
+        self.end += nbytes
+
+    def next_message(self, codec):
+        # The next complete message, or None until more bytes arrive
+        msg, self.start = codec.next_frame(self.data, self.start, self.end)
+        return msg
+
+class Connection(asyncio.BufferedProtocol):
+
+    # One socket on the event loop. The transport reads into a ReceiveBuffer,
+    # which keeps any partial frame until the rest of it arrives.
+    # on_message(msg, conn) runs for each decoded message, on_close(conn) once
+    # the socket is gone. codec decodes inbound frames and out_codec encodes
+    # outbound ones; both start as JSON and change only through negotiation.
+
+    # Bytes the transport may buffer before pausing us, and bytes we queue
+    # past that before applying OVERFLOW_POLICY (see OutboundQueue)
+    HIGH_WATER = 64 * 1024
+    OUTBOUND_LIMIT = 256 * 1024
+    OVERFLOW_POLICY = 'snapshot'
+    # How long close() waits for a paused peer to take the frames still
+    # queued for it before dropping it
+    DRAIN_TIMEOUT = 5
+
+    def __init__(self, on_message, on_close=None, on_open=None,
+                 outbound_limit=None, overflow_policy=None):
+        self.on_message = on_message
+        self.on_close = on_close
+        self.on_open = on_open
+        self.transport = None
+        self.loop = None
+        self.buffer = ReceiveBuffer()
+        self.closed = False
+        self.lost = None
+        # Timer that aborts a close() still waiting on the outbound queue
+        self.draining = None
+        self.codec = protocol.JSON
+        self.out_codec = protocol.JSON
+        # True once the peer has taken part in protocol negotiation
+        self.negotiated = False
+        # While corked, outbound frames are held and written together on uncork
+        self.corked = 0
+        self.corked_frames = []
+        self.outbound = OutboundQueue(
+                self,
+                outbound_limit if outbound_limit is not None else self.OUTBOUND_LIMIT,
+                overflow_policy if overflow_policy is not None else self.OVERFLOW_POLICY)
+        # Returns the (type, args, kwargs) to resync this peer after overflow
+        self.snapshot_source = None
+        # For metrics: bytes read and handed to the transport, and the
+        # addresses at either end
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.local = None
+        self.peer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.HIGH_WATER)
+        self.loop = asyncio.get_event_loop()
+        self.lost = self.loop.create_future()
+        self.local = address(transport.get_extra_info('sockname'))
+        self.peer = address(transport.get_extra_info('peername'))
+        metrics.connection_opened(self)
+        if self.on_open is not None:
+            self.on_open(self)
+
+    def get_buffer(self, sizehint):
+        return self.buffer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.bytes_received += nbytes
+        self.buffer.filled(nbytes)
+        while not self.closed:
+            # Re-read self.codec each frame: a message may switch protocols
+            msg = self.buffer.next_message(self.codec)
+            if msg is None:
+                break
+            self.on_message(msg, self)
+        if len(self.buffer) > self.buffer.MAX_FRAME and not self.closed:
+            log_warn("Dropping connection: no end to a frame in %d bytes", len(self.buffer))
+            self.abort()
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            log_warn("Connection lost: %s", exc)
+        self.closed = True
+        if self.draining is not None:
+            self.draining.cancel()
+        metrics.connection_closed(self)
+        if not self.lost.done():
+            self.lost.set_result(None)
+        if self.on_close is not None:
+            self.on_close(self)
+
+    def send(self, msg, keep=False):
+        if (self.closed or self.draining is not None or
+                self.transport is None or self.transport.is_closing()):
+            return
+        if not isinstance(msg, bytes):
+            msg = msg.encode('utf-8')
+        if self.corked:
+            self.corked_frames.append((msg, keep))
+        else:
+            self.outbound.push(msg, keep)
+
+    def pause_writing(self):
+        self.outbound.pause()
+
+    def resume_writing(self):
+        self.outbound.resume()
+        if self.draining is not None and not self.outbound.pending():
+            self.draining.cancel()
+            # On the next iteration, as in OutboundQueue.give_up
+            self.loop.call_soon(self.transport.close)
+
+    def cork(self):
+        self.corked += 1
+
+    def uncork(self):
+        self.corked -= 1
+        if self.corked == 0 and self.corked_frames:
+            frames, self.corked_frames = self.corked_frames, []
+            # Frames to keep go apart from the rest, which an overflow may drop
+            for keep, run in itertools.groupby(frames, lambda frame: frame[1]):
+                self.send(b''.join(data for data, _ in run), keep)
+
+    def send_message(self, type, args, kwargs):
+        try:
+            frame = protocol.frame_for(self, type, args, kwargs)
+        except protocol.FrameTooLarge as e:
+            # Carrying on without it would leave the peer out of step
+            log_warn("Dropping connection: %s", e)
+            self.abort()
+            return
+        self.send(frame, type in protocol.MUST_DELIVER)
+
+    def send_message_threadsafe(self, type, args, kwargs):
+        # For senders outside the event loop thread (e.g. the UI control loop).
+        # Encoding happens on the loop so it always uses the current out_codec
+        try:
+            self.loop.call_soon_threadsafe(self.send_message, type, args, kwargs)
+        except RuntimeError:
+            log_warn("Event loop closed; dropping message %s", type)
+
+    def close(self):
+        if (self.transport is None or self.transport.is_closing() or
+                self.draining is not None):
+            return
+        if self.outbound.pending():
+            # Finished in resume_writing once the queue empties
+            self.draining = self.loop.call_later(self.DRAIN_TIMEOUT, self.abort)
+            return
+        self.transport.close()
+
+    def abort(self):
+        # Close without flushing whatever the transport still has buffered
+        if self.transport is not None:
+            self.transport.abort()
+
+    async def wait_closed(self, timeout=None):
+        if self.lost is not None:
+            await asyncio.wait([self.lost], timeout=timeout)
+
+@contextlib.contextmanager
+def batch(conns):
+    # Everything sent to conns inside the block goes out as one write each
+    conns = list(conns)
+    for conn in conns:
+        conn.cork()
+    try:
+        yield
+    finally:
+        for conn in conns:
+            conn.uncork()
@@ -1,4 +1,6 @@
+import sys
 import time
+import heapq
 import traceback
 from logger import *
 import model
@@ -6,6 +8,9 @@ import curses
 import re
 from threading import Thread
 from remote import MsgHandler
+from geometry import STANDARD
+
+LOG = get_log('ui')
 
 INVERT = False
 
@@ -97,18 +102,31 @@ class CardDrawing:
     WIDTH = 32
     HEIGHT = 10
 
+    # Rendered text by (shape, number, shading). Color is only an attribute,
+    # so every card shares one of 27 faces
+    FACES = {}
+
     def __init__(self, color, shape, number, shading):
         self.color, self.shape, self.number, self.shading = \
                 color, shape, number, shading
 
         self.win = None
         self.y, self.x = None, None
-        try:
-            text = self.shade(shape, shading)
-        except Exception as e: # FIXME: o.O
-            text = self.shade(shape, '#')
+        self.labelled = False
+        self.text = self.face(shape, number, shading)
 
-        self.text = center_lines(concat_lines([text] * number), self.WIDTH)
+    @classmethod
+    def face(cls, shape, number, shading):
+        key = (shape, number, shading)
+        text = cls.FACES.get(key)
+        if text is None:
+            try:
+                shaded = cls.shade(shape, shading)
+            except Exception as e: # FIXME: o.O
+                shaded = cls.shade(shape, '#')
+            text = center_lines(concat_lines([shaded] * number), cls.WIDTH)
+            cls.FACES[key] = text
+        return text
 
     @staticmethod
     def shade(text, fill):
@@ -120,20 +138,25 @@ class CardDrawing:
                 lambda x: x.group(0).replace(' ', fill).replace('_', fill),
                 text)
 
-    def redraw(self):
-        self.undraw('-', 1)
-        self.draw(self.y, self.x)
+    # Drawing only updates curses' virtual screen (noutrefresh); the Board
+    # sends everything to the terminal at once in flush()
 
+    def touch(self):
+        # Repaint the card as it is, e.g. after a resize
+        if self.win is not None:
+            self.win.touchwin()
+            self.win.noutrefresh()
 
     def draw(self, y, x):
-        log("Drawing card at %d, %d", y, x)
+        LOG.debug("Drawing card at %d, %d", y, x)
         self.y, self.x = y, x
         if self.win is None:
             self.win = curses.newwin(self.HEIGHT, self.WIDTH + 2, y, x)
-        self.win.clear()
+        # erase() rather than clear(): only the cells that change are resent
+        self.win.erase()
         self.win.bkgd(self.color.normal)
         self.win.addstr(0, 0, self.text, self.color.normal)
-        self.win.refresh()
+        self.win.noutrefresh()
 
     def set_selection(self, is_on):
         if self.win is None:
@@ -147,24 +170,28 @@ class CardDrawing:
 
         self.win.bkgd(col)
         self.win.addstr(0, 0, self.text, col)
-        self.win.refresh()
+        self.win.noutrefresh()
 
     def undraw(self, bgchar, bgcol=None):
         if self.win is None:
             log_warn("Cannot undraw undrawn card")
             return
-        self.win.clear()
+        self.win.erase()
         self.win.bkgd(bgchar, bgcol)
-        self.win.refresh()
-        log("Undrawed card!")
+        self.win.noutrefresh()
+        LOG.debug("Undrawed card!")
 
     def label(self, label):
         self.win.addstr(self.HEIGHT - 2, self.WIDTH - 1, label)
-        self.win.refresh()
+        self.win.noutrefresh()
+        self.labelled = True
 
     def unlabel(self):
+        if not self.labelled:
+            return
         self.win.addstr(self.HEIGHT - 2, self.WIDTH - 1, ' ')
-        self.win.refresh()
+        self.win.noutrefresh()
+        self.labelled = False
 
 class Color:
 
@@ -217,8 +244,9 @@ class Board:
     OFFSET_X = 10
     OFFSET_Y = 5
 
-    N_COLS = 3
-    N_ROWS = 4
+    GEOMETRY = STANDARD
+    N_COLS = GEOMETRY.n_cols
+    N_ROWS = GEOMETRY.n_rows
 
     ROW_WIDTH = 35
     ROW_HEIGHT = 11
@@ -263,19 +291,19 @@ class Board:
 
         self.msgwin = curses.newwin(3, 75, 1, 2)
         self.msgwin.bkgd(self.msgcol.normal)
-        self.msgwin.refresh()
+        self.msgwin.noutrefresh()
         self.resize()
 
 
     @classmethod
     def resize(self):
         curses.resizeterm((self.N_ROWS)* (self.ROW_HEIGHT + 2),
-                          (self.N_COLS + 2) * (self.ROW_WIDTH + 5))
+                          (self.N_COLS) * (self.ROW_WIDTH + 5))
 
     @classmethod
     def is_resized(self):
         if curses.is_term_resized((self.N_ROWS)* (self.ROW_HEIGHT + 2),
-                (self.N_COLS + 2) * (self.ROW_WIDTH + 5)):
+                (self.N_COLS) * (self.ROW_WIDTH + 5)):
             log("WINDOW WAS RESIZED!")
             return True
         return False
@@ -283,14 +311,29 @@ class Board:
 
     def refresh(self):
         self.resize()
-        self.stdscr.refresh()
-        self.msgwin.refresh()
+        self.stdscr.touchwin()
+        self.stdscr.noutrefresh()
+        self.msgwin.touchwin()
+        self.msgwin.noutrefresh()
         for card in self.cards.values():
-            card.redraw()
+            card.touch()
+
+    def flush(self):
+        # One terminal update for everything drawn since the last flush
+        curses.doupdate()
 
     def init(self):
         self.stdscr.bkgd('-', self.bgcol.normal)
-        self.stdscr.refresh()
+        self.stdscr.noutrefresh()
+        self.build_faces()
+        self.flush()
+
+    @classmethod
+    def build_faces(cls):
+        for shape in cls.SHAPES.values():
+            for shading in cls.SHADINGS.values():
+                for number in range(1, 4):
+                    CardDrawing.face(shape, number, shading)
 
     def card_drawing_kwargs(self, card):
         return dict(
@@ -317,22 +360,18 @@ class Board:
 
     @classmethod
     def containing_card(cls, x, y):
-        for c_x in range(cls.N_COLS + 2):
-            for c_y in range(cls.N_ROWS):
-                start_y, start_x = cls.card_coords(c_x, c_y)
-                if x > start_x and x < start_x + cls.ROW_WIDTH and \
-                        y > start_y and y < start_y + cls.ROW_HEIGHT:
-                    return c_x, c_y
-        return None, None
+        return cls.GEOMETRY.cell_at(x, y, cls.OFFSET_X, cls.OFFSET_Y,
+                                    cls.ROW_WIDTH, cls.ROW_HEIGHT)
 
     def draw_card(self, card, x, y):
         # TODO: This try block is... annoying...
         # Changes the "full" shading to "#" if the current one can't be displayed
         try:
             kwargs = self.card_drawing_kwargs(card)
-            if (x,y) in self.cards:
-                self.cards[(x,y)].undraw('-', self.bgcol.normal)
             drawing = CardDrawing(**kwargs)
+            if (x,y) in self.cards:
+                # Paint over the old card's window so only the difference is sent
+                drawing.win = self.cards[(x,y)].win
             drawing.draw(*self.card_coords(x,y))
             self.cards[(x,y)] = drawing
         except Exception as e:
@@ -350,10 +389,10 @@ class Board:
         del self.cards[(x,y)]
 
     def display_message(self, message):
-        self.msgwin.clear()
+        self.msgwin.erase()
         self.msgwin.bkgd(' ', self.msgcol.normal)
         self.msgwin.addstr(1, 1, message)
-        self.msgwin.refresh()
+        self.msgwin.noutrefresh()
 
     def label_card(self, x, y, label):
         if (x,y) not in self.cards:
@@ -365,33 +404,83 @@ class Board:
         for card in self.cards.values():
             card.unlabel()
 
+def control_msg(type, **kwargs):
+    return dict(type = type, args = [], kwargs = kwargs)
+
+def key_messages(ch):
+    # The control messages one getch() result turns into; 'quit' is last
+    msgs = []
+    if Board.is_resized():
+        msgs.append(control_msg('resize'))
+    if ch in (curses.KEY_BACKSPACE, ord('\x7f'), ord('\b'), '\x08'):
+        msgs.append(control_msg('quit'))
+    elif ch == curses.KEY_RESIZE:
+        msgs.append(control_msg('resize'))
+    elif ch == curses.KEY_MOUSE:
+        _, x, y, _, _ = curses.getmouse()
+        msgs.append(control_msg('mousepress', x = x, y = y))
+    else:
+        try:
+            msgs.append(control_msg('keypress', key = chr(ch)))
+        except:
+            msgs.append(control_msg('show_message', message="Don't press things you're not supposed to"))
+    return msgs
+
 def key_monitor(stdscr, queue):
     while True:
         ch = stdscr.getch()
         if queue.exiting:
             return
-
-        if Board.is_resized():
-            queue.enqueue_msg('resize')
-        if ch in (curses.KEY_BACKSPACE, ord('\x7f'), ord('\b'), '\x08'):
-            queue.enqueue_msg('quit')
-            return
-        if ch == curses.KEY_RESIZE:
-            queue.enqueue_msg('resize')
-        elif ch == curses.KEY_MOUSE:
-            _, x, y, _, _ = curses.getmouse()
-            queue.enqueue_msg('mousepress', x = x, y = y)
-        else:
-            try:
-                queue.enqueue_msg('keypress', key = chr(ch))
-            except:
-                queue.enqueue_msg('show_message', message="Don't press things you're not supposed to")
+        for msg in key_messages(ch):
+            queue.enqueue_obj(msg)
+            if msg['type'] == 'quit':
+                return
 
 CONTROL_HANDLERS = {}
 
+class Scheduler:
+
+    # Work for the control loop to run between messages, in order of due time
+
+    def __init__(self):
+        self.heap = []
+        self.seq = 0
+
+    def call_at(self, when, fn, *args):
+        entry = [when, self.seq, fn, args]
+        self.seq += 1
+        heapq.heappush(self.heap, entry)
+        return entry
+
+    def call_later(self, delay, fn, *args):
+        return self.call_at(time.time() + delay, fn, *args)
+
+    def cancel(self, entry):
+        entry[2] = None
+
+    def timeout(self):
+        # Seconds until the next entry is due, None if there are none
+        while self.heap and self.heap[0][2] is None:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return max(0, self.heap[0][0] - time.time())
+
+    def run_due(self):
+        # Runs everything due; returns the first non-None result
+        rtn = None
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            _, _, fn, args = heapq.heappop(self.heap)
+            if fn is not None:
+                result = fn(*args)
+                if rtn is None:
+                    rtn = result
+        return rtn
+
 class LocalController:
 
-    H = MsgHandler()
+    H = MsgHandler('ui')
 
     KEYS = [
             ['1', '2', '3', '4', '5'],
@@ -400,6 +489,11 @@ class LocalController:
             ['z', 'x', 'c', 'v', 'b'],
         ]
 
+    # Placed cards appear one at a time, PLACE_DELAY apart; a whole board
+    # (board_snapshot) is dealt within DEAL_TIME
+    PLACE_DELAY = .1
+    DEAL_TIME = .6
+    END_GAME_DELAY = 5
 
     def __init__(self, board, host, queue):
         self.board = board
@@ -411,6 +505,21 @@ class LocalController:
         self.selected = {}
         self.selecting_set = False
         self.client_id = None
+        self.ending = False
+
+        self.scheduler = Scheduler()
+        # (x, y) => scheduled draw of a placed card not shown yet
+        self.unrevealed = {}
+        self.next_reveal = 0
+
+        # Used by run(); control_loop() works from the queue instead
+        self.loop = None
+        self.stdscr = None
+        self.finished = None
+        self.result = None
+        self.quit_pressed = False
+        self.batch = None
+        self.timer = None
 
         self.H.bind(self)
 
@@ -452,22 +561,27 @@ class LocalController:
 
     @H.register('remove')
     def handle_remove_card(self, card, x, y):
-        log("Removing card...")
+        LOG.debug("Removing card...")
         if (x,y) in self.layout:
             del self.layout[(x,y)]
         if (x,y) in self.selected:
             del self.selected[(x,y)]
-        self.board.undraw_card(x,y)
+        if (x,y) in self.unrevealed:
+            self.scheduler.cancel(self.unrevealed.pop((x,y)))
+        else:
+            self.board.undraw_card(x,y)
 
     @H.register('select')
     def handle_select(self, card, x, y):
         self.selected[(x, y)] = card
+        self.reveal(x, y)
         self.board.select_card(x, y)
 
     @H.register('deselect')
     def handle_deselect(self, card, x, y):
         if (x,y) in self.selected:
             del self.selected[(x, y)]
+        self.reveal(x, y)
         self.board.deselect_card(x, y)
 
     @H.register('mousepress')
@@ -509,11 +623,45 @@ class LocalController:
 
     @H.register('place')
     def handle_place(self, card, x, y):
-        log("Placing card %s at (%d, %d)", card, x, y)
+        self.place_card(card, x, y, self.PLACE_DELAY)
+
+    def place_card(self, card, x, y, delay):
+        LOG.debug("Placing card %s at (%d, %d)", card, x, y)
         card = model.Card(*card)
         self.layout[(x,y)] = card
-        self.board.draw_card(card, x, y)
-        time.sleep(.1)
+        # The card is in play now but drawn once the ones before it are
+        due = max(time.time(), self.next_reveal)
+        self.next_reveal = due + delay
+        self.unrevealed[(x,y)] = self.scheduler.call_at(due, self.reveal, x, y)
+
+    def reveal(self, x, y):
+        entry = self.unrevealed.pop((x,y), None)
+        if entry is None:
+            return
+        self.scheduler.cancel(entry)
+        self.board.draw_card(self.layout[(x,y)], x, y)
+
+    def reveal_all(self):
+        for (x, y) in sorted(self.unrevealed, key=lambda xy: self.unrevealed[xy][:2]):
+            self.reveal(x, y)
+        self.next_reveal = 0
+
+    @H.register('board_snapshot')
+    def handle_board_snapshot(self, cards, selected=(), scores=None, yeller=None):
+        # The whole game, including whether anyone is selecting a set
+        self.selecting_set = False
+        self.board.unlabel_cards()
+        for (x, y) in list(self.layout):
+            self.handle_remove_card(None, x, y)
+        delay = min(self.PLACE_DELAY, self.DEAL_TIME / max(len(cards), 1))
+        for card, x, y in cards:
+            self.place_card(card, x, y, delay)
+        if scores is not None:
+            self.handle_score_update(scores)
+        if yeller is not None:
+            self.handle_set_yelled(yeller)
+        for x, y in selected:
+            self.handle_select(self.layout[(x, y)], x, y)
 
     @H.register('show_message')
     def handle_show_message(self, message):
@@ -527,6 +675,7 @@ class LocalController:
 
     def handle_self_set_yelled(self):
         self.selecting_set = True
+        self.reveal_all()
         self.board.display_message("Found a set? Select it!")
         for y, row in enumerate(self.KEYS):
             for x, key in enumerate(row):
@@ -567,6 +716,10 @@ class LocalController:
 
     @H.register('end_game')
     def handle_end_game(self, scores = {}, message=''):
+        if self.ending:
+            # e.g. the host disconnecting after it announced the end
+            return
+        self.ending = True
         if len(scores) > 0:
             scores_txt = []
             for client, score in scores.items():
@@ -580,12 +733,18 @@ class LocalController:
             else:
                 win_score = 0
             scores_txt = ' | '.join(scores_txt)
-            if win_score == scores[str(self.client_id)]:
+            if self.client_id is None:
+                # Watching a replay: nobody to congratulate
+                message = message + scores_txt
+            elif win_score == scores[str(self.client_id)]:
                 message = message + scores_txt + " :: YOU WINN!"
             else:
                 message = message + scores_txt + " :: YOU LOOOOSE."
+        self.reveal_all()
         self.board.display_message(message)
-        time.sleep(5)
+        self.scheduler.call_later(self.END_GAME_DELAY, self.finish, message)
+
+    def finish(self, message):
         self.board.display_message("Press any key to quit")
         return message
 
@@ -599,9 +758,17 @@ class LocalController:
 
         log("Entering loop")
         while True:
-            msg = self.queue.dequeue()
-            log("UI Received message %s", msg)
-            rtn = self.H.handle(msg['type'], msg['args'], msg['kwargs'])
+            # Wait for a message, but no longer than the next scheduled work
+            msg = self.queue.dequeue(self.scheduler.timeout())
+            rtn = None
+            if msg is not None:
+                LOG.debug("UI Received message %s", msg)
+                rtn = self.H.handle(msg['type'], msg['args'], msg['kwargs'])
+            if rtn is None:
+                rtn = self.scheduler.run_due()
+            # Whatever this batch of messages drew goes out in one update
+            if rtn is not None or self.queue.empty():
+                self.board.flush()
             if rtn is not None:
                 rtn_arr.append(rtn)
                 log("Exiting control loop")
@@ -611,3 +778,82 @@ class LocalController:
                 curses.mousemask(0)
                 stdscr.keypad(False)
                 return
+
+    def run(self, loop, stdscr):
+        # Single-threaded alternative to control_loop: key presses, host
+        # messages (passed to deliver()) and scheduled work all run as
+        # callbacks on loop. Returns a future for the game's result.
+        self.loop = loop
+        self.stdscr = stdscr
+        self.finished = loop.create_future()
+        stdscr.nodelay(True)
+        loop.add_reader(sys.stdin.fileno(), self.keys_ready)
+        self.board.display_message("Press SPACE to call set | BACKSPACE to quit")
+        self.end_batch()
+        return self.finished
+
+    def deliver(self, msg):
+        if self.finished.done() or self.result is not None:
+            return
+        LOG.debug("UI Received message %s", msg)
+        rtn = self.H.handle(msg['type'], msg['args'], msg['kwargs'])
+        if rtn is not None:
+            self.game_over(rtn)
+        # Everything handled before the loop comes back around is one batch
+        if self.batch is None and not self.finished.done():
+            self.batch = self.loop.call_soon(self.end_batch)
+
+    def keys_ready(self):
+        # Read everything waiting before handling any of it: a resize makes
+        # curses queue another KEY_RESIZE, which waits for the next key
+        msgs = []
+        while True:
+            ch = self.stdscr.getch()
+            if ch == -1:
+                break
+            for msg in key_messages(ch):
+                if msg['type'] != 'resize' or control_msg('resize') not in msgs:
+                    msgs.append(msg)
+        if msgs and self.result is not None:
+            # "Press any key to quit"
+            self.stop()
+            return
+        for msg in msgs:
+            if self.quit_pressed or self.finished.done():
+                return
+            self.quit_pressed = msg['type'] == 'quit'
+            self.deliver(msg)
+
+    def end_batch(self):
+        self.batch = None
+        if self.finished.done():
+            return
+        rtn = self.scheduler.run_due()
+        if rtn is not None:
+            self.game_over(rtn)
+        self.board.flush()
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        timeout = self.scheduler.timeout()
+        if timeout is not None and not self.finished.done():
+            self.timer = self.loop.call_later(timeout, self.end_batch)
+
+    def game_over(self, rtn):
+        log("Game over: %s", rtn)
+        self.result = rtn
+        self.board.flush()
+        # Someone who quit has already pressed their key
+        if self.quit_pressed:
+            self.stop()
+
+    def stop(self):
+        self.loop.remove_reader(sys.stdin.fileno())
+        for handle in (self.batch, self.timer):
+            if handle is not None:
+                handle.cancel()
+        self.batch = self.timer = None
+        self.stdscr.nodelay(False)
+        curses.mousemask(0)
+        self.stdscr.keypad(False)
+        self.finished.set_result(self.result)